@@ -0,0 +1,297 @@
+## Sean Landry
+
+import math
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class LocalLimiter():
+    """
+    In-memory token buckets, one per key.  Buckets hold up to burst tokens
+    and refill at rate tokens per second.  Limits apply per API process.
+    Full buckets are indistinguishable from new ones, so they are dropped
+    once per refill period to keep memory bounded by the active clients.
+
+    """
+
+    def __init__(self, rate, burst, clock = time.monotonic):
+        """
+        Args:
+            rate (float):  tokens added per second.
+
+            burst (int):  bucket capacity.
+
+        Kwargs:
+            clock (callable):  returns the current time in seconds.
+
+        """
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.clock = clock
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._swept = clock()
+
+    def consume(self, key, tokens = 1):
+        """
+        Take tokens from the bucket of key.
+
+        Returns:
+            (bool, float):  allowed, seconds until enough tokens are available.
+
+        """
+        with self._lock:
+            now = self.clock()
+            self._sweep(now)
+            available, ts = self._buckets.get(key, (self.burst, now))
+            available = min(self.burst, available + max(0.0, now - ts) * self.rate)
+            if available >= tokens:
+                self._buckets[key] = (available - tokens, now)
+                return True, 0.0
+            self._buckets[key] = (available, now)
+        return False, _retry_after(tokens - available, self.rate)
+
+    def _sweep(self, now):
+        """
+        Drop the buckets that refilled to burst, at most once per refill
+        period.
+        """
+        if self.rate <= 0 or now - self._swept < self.burst / self.rate:
+            return
+        self._swept = now
+        full = [k for k, (available, ts) in self._buckets.items()
+                if available + (now - ts) * self.rate >= self.burst]
+        for k in full:
+            del self._buckets[k]
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+## atomic token bucket, the redis clock is used so API nodes share one time
+## source
+_REDIS_TOKEN_BUCKET = """
+redis.replicate_commands()
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= requested then
+    tokens = tokens - requested
+    allowed = 1
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+if rate > 0 then
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+end
+return {allowed, tostring(tokens)}
+"""
+
+
+class RedisLimiter():
+    """
+    Token buckets shared by every API process through redis.  A bucket
+    expires once it would have refilled to burst.
+
+    """
+
+    def __init__(self, client, rate, burst, prefix = "labstro:admission:"):
+        """
+        Args:
+            client (redis.Redis):  redis client.
+
+            rate (float):  tokens added per second.
+
+            burst (int):  bucket capacity.
+
+        Kwargs:
+            prefix (str):  key prefix of the buckets.
+
+        """
+        self.client = client
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.prefix = prefix
+        self._script = client.register_script(_REDIS_TOKEN_BUCKET)
+
+    @classmethod
+    def from_url(cls, url, rate, burst, **kwargs):
+        import redis
+        return cls(redis.Redis.from_url(url), rate, burst, **kwargs)
+
+    def consume(self, key, tokens = 1):
+        """
+        Take tokens from the bucket of key.
+
+        Returns:
+            (bool, float):  allowed, seconds until enough tokens are available.
+
+        """
+        allowed, available = self._script(keys = [self.prefix + key],
+                                          args = [self.rate, self.burst, tokens])
+        if int(allowed):
+            return True, 0.0
+        return False, _retry_after(tokens - float(available), self.rate)
+
+
+def _retry_after(missing, rate):
+    if rate <= 0:
+        return float("inf")
+    return missing / rate
+
+
+class AdmissionControl():
+    """
+    Admission control for task submissions.  A request is admitted when the
+    client and the task name both have tokens left and the queue the task
+    routes to is not deeper than max_queue_depth, otherwise it is rejected
+    with 429 Too Many Requests and a Retry-After header.
+
+    """
+
+    def __init__(self, celery, client_limiter = None, task_limiter = None,
+                 max_queue_depth = None, depth_ttl = 1.0, queue_depth = None,
+                 depth_retry_after = 5):
+        """
+        Args:
+            celery (celery.Celery):  instance of a Celery application.
+
+        Kwargs:
+            client_limiter (LocalLimiter or RedisLimiter):  buckets per client.
+
+            task_limiter (LocalLimiter or RedisLimiter):  buckets per task name.
+
+            max_queue_depth (int):  reject submissions to queues holding more
+                messages, disabled when None.
+
+            depth_ttl (float):  seconds a measured queue depth is reused.
+
+            queue_depth (callable):  returns the depth of a queue name,
+                defaults to a passive declare on the broker.
+
+            depth_retry_after (int):  Retry-After sent when a queue is full.
+
+        """
+        self.celery = celery
+        self.client_limiter = client_limiter
+        self.task_limiter = task_limiter
+        self.max_queue_depth = max_queue_depth
+        self.depth_ttl = depth_ttl
+        self.queue_depth = queue_depth or self._broker_queue_depth
+        self.depth_retry_after = depth_retry_after
+        self._depths = {}
+
+    @classmethod
+    def from_config(cls, celery):
+        """
+        Build admission control from the LABSTRO_ADMISSION_* settings.
+        """
+        conf = celery.conf
+        backend = conf.get("LABSTRO_ADMISSION_BACKEND", "local")
+
+        def limiter(rate, burst):
+            if rate is None:
+                return None
+            if backend == "redis":
+                return RedisLimiter.from_url(conf["LABSTRO_ADMISSION_REDIS_URL"], rate, burst)
+            return LocalLimiter(rate, burst)
+
+        return cls(celery,
+                   client_limiter = limiter(conf.get("LABSTRO_ADMISSION_CLIENT_RATE", None),
+                                            conf.get("LABSTRO_ADMISSION_CLIENT_BURST", 1)),
+                   task_limiter = limiter(conf.get("LABSTRO_ADMISSION_TASK_RATE", None),
+                                          conf.get("LABSTRO_ADMISSION_TASK_BURST", 1)),
+                   max_queue_depth = conf.get("LABSTRO_ADMISSION_MAX_QUEUE_DEPTH", None),
+                   depth_ttl = conf.get("LABSTRO_ADMISSION_QUEUE_DEPTH_TTL", 1.0))
+
+    def _broker_queue_depth(self, queue):
+        with self.celery.connection_for_write() as conn:
+            return conn.default_channel.queue_declare(queue = queue, passive = True).message_count
+
+    def depth(self, queue):
+        """
+        Return the number of messages waiting in a queue, measured at most
+        once per depth_ttl seconds.
+        """
+        now = time.monotonic()
+        cached = self._depths.get(queue, None)
+        if cached is not None and now - cached[1] < self.depth_ttl:
+            return cached[0]
+
+        try:
+            depth = self.queue_depth(queue)
+        except Exception as e:
+            logger.warning("unable to measure depth of " + queue + ": " + str(e))
+            depth = 0
+        self._depths[queue] = (depth, now)
+        return depth
+
+    def _queue(self, task_name):
+        queue = self.celery.amqp.router.route({}, task_name).get("queue", None)
+        return getattr(queue, "name", queue)
+
+    def admit(self, client_id, task_name):
+        """
+        Decide whether a submission is admitted.
+
+        Args:
+            client_id (str):  identity of the client.
+
+            task_name (str):  name of the submitted task.
+
+        Returns:
+            None when admitted, otherwise a flask_restful response tuple
+            (dict, 429, {"Retry-After": str}).
+
+        """
+        return self.admit_many(client_id, {task_name: 1})
+
+    def admit_many(self, client_id, tasks):
+        """
+        Decide whether a submission of many tasks, e.g. a campaign, is
+        admitted.  Each task takes one token, a submission larger than a
+        bucket takes the whole bucket.
+
+        Args:
+            client_id (str):  identity of the client.
+
+            tasks (dict):  number of submitted tasks per task name.
+
+        Returns:
+            None when admitted, otherwise a flask_restful response tuple
+            (dict, 429, {"Retry-After": str}).
+
+        """
+        if self.max_queue_depth is not None:
+            for task_name in sorted(tasks):
+                queue = self._queue(task_name)
+                depth = self.depth(queue)
+                if depth > self.max_queue_depth:
+                    logger.warning("rejecting " + task_name + ", queue " + queue + " depth " + str(depth))
+                    return _too_many("queue " + queue + " is full", self.depth_retry_after)
+
+        checks = [(self.client_limiter, "client:" + client_id, sum(tasks.values()))]
+        checks += [(self.task_limiter, "task:" + n, count) for n, count in sorted(tasks.items())]
+        for limiter, key, tokens in checks:
+            if limiter is None:
+                continue
+            allowed, retry_after = limiter.consume(key, min(tokens, limiter.burst))
+            if not allowed:
+                logger.warning("rate limited " + key)
+                return _too_many("rate limit exceeded for " + key, retry_after)
+        return None
+
+
+def _too_many(reason, retry_after):
+    retry_after = max(1, int(math.ceil(min(retry_after, 3600))))
+    return {"result": "too many requests", "exc": reason}, 429, {"Retry-After": str(retry_after)}
@@ -4,12 +4,19 @@ import os
 import json
 from jsonschema import validate
 from jsonschema.exceptions import ValidationError
-from flask import request
+from flask import request, send_file
 from flask_restful import Resource, Api
 import importlib
+from celery import states
 from celery.result import AsyncResult
 from itertools import chain
+from collections import Counter
 import logging
+from ..pools import ConnectionPools
+from .index import TaskIndex
+from ..tracing import chrome_trace
+from ..campaign import CampaignCompiler
+from ..scheduling import DeadlineScheduler
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -40,6 +47,187 @@ def task_signature(TaskFunction, data):
     if not data.get("args", False) and not data.get("kwargs", False):
         return TaskFunction.s()
 
+def task_priority(data, max_priority = None):
+    """
+    Unpack the message priority from a request.
+
+    Args:
+        data (dict):  parsed json body of a request.
+
+    Kwargs:
+        max_priority (int):  highest priority supported by the queues, larger
+            values are clamped.
+
+    Returns:
+        (int):  priority or None when not requested.
+
+    """
+    priority = data.get("priority", None)
+    if priority is None:
+        return None
+
+    priority = max(int(priority), 0)
+    if max_priority is not None:
+        priority = min(priority, max_priority)
+    return priority
+
+def signature_tasks(sig):
+    """
+    Count the tasks of a signature, chain or group.
+
+    Args:
+        sig (celery.canvas.Signature):  workflow.
+
+    Returns:
+        (collections.Counter):  number of tasks per task name.
+
+    """
+    tasks = getattr(sig, "tasks", None)
+    if tasks is None:
+        return Counter([sig.task])
+    counts = Counter()
+    for t in tasks:
+        counts.update(signature_tasks(t))
+    return counts
+
+def task_result_data(r):
+    """
+    Serialize a celery result for a response.
+
+    Args:
+        r (celery.result.AsyncResult):  task result.
+
+    Returns:
+        (dict)
+
+    """
+    return {"task_id": r.id,
+            "state": r.state,
+            "result": r.result,
+            "traceback": str(r.traceback)}
+
+def client_id():
+    """
+    Identify the client of a request by its remote address, headers set by
+    the client are not trusted.  Behind reverse proxies the address is taken
+    from X-Forwarded-For by werkzeug's ProxyFix, see
+    LABSTRO_ADMISSION_PROXY_COUNT.
+    """
+    return request.remote_addr or "unknown"
+
+def conditional_response(data, etag):
+    """
+    Respond with an ETag, or 304 Not Modified when it matches the
+    If-None-Match header of the request.
+
+    Args:
+        data (list or dict):  response body.
+
+        etag (str):  entity tag of data.
+
+    Returns:
+        (list or dict), 200 or 304, (dict)
+
+    """
+    headers = {"ETag": '"' + etag + '"'}
+    if request.if_none_match.contains(etag):
+        return None, 304, headers
+    return data, 200, headers
+
+def task_transition_response(celery, task_id):
+    """
+    Respond to a device callback, the stored result is read back unless the
+    request sets the query parameter read_back=false.
+
+    Args:
+        celery (celery.Celery):  instance of a Celery application.
+
+        task_id (str):  id of the updated task.
+
+    Returns:
+        (dict), 200
+
+    """
+    if request.args.get("read_back", "true").lower() == "false":
+        return {"task_id": task_id}, 200
+    return task_result_data(celery.AsyncResult(task_id)), 200
+
+## state names accepted from devices mapped to the states stored by the
+## started, success and failed endpoints
+TRANSITION_STATES = {"started": states.STARTED,
+                     "success": states.SUCCESS,
+                     "failed": "FAILED"}
+
+def transition_state(state):
+    """
+    Normalize the state of a device transition.
+
+    Args:
+        state (str):  e.g. "started", "success", "failed" or a celery state.
+
+    Returns:
+        (str): state to store.
+
+    """
+    if state.lower() in TRANSITION_STATES:
+        return TRANSITION_STATES[state.lower()]
+    if state.upper() in states.ALL_STATES:
+        return state.upper()
+    raise ValueError("unknown state: " + state)
+
+def store_results(backend, transitions):
+    """
+    Store many task state transitions.  Key/value backends with a redis
+    client are written with a single pipeline, other backends fall back to
+    one store_result call per transition.  As with store_result, tasks that
+    already succeeded are not overwritten.
+
+    Args:
+        backend (celery.backends.base.Backend):  result backend.
+
+        transitions (list):  [(task_id, state, result), ...]
+
+    Returns:
+        (list, list): ids of stored and skipped tasks.
+
+    """
+    client = getattr(backend, "client", None)
+    if not hasattr(client, "pipeline") or not hasattr(backend, "get_key_for_task"):
+        for task_id, state, result in transitions:
+            backend.store_result(task_id, result, state, traceback = None)
+        return [t[0] for t in transitions], []
+
+    keys = [backend.get_key_for_task(t[0]) for t in transitions]
+    current = client.mget(keys) if keys else []
+
+    stored, skipped = [], []
+    ## states written earlier in this batch, the reads above predate them
+    written = {}
+    with client.pipeline() as pipe:
+        for key, value, (task_id, state, result) in zip(keys, current, transitions):
+            status = written.get(task_id, None)
+            if status is None and value:
+                status = backend.decode_result(value)["status"]
+            if status == states.SUCCESS:
+                skipped.append(task_id)
+                continue
+
+            ## the record written by store_result, including date_done
+            meta = backend._get_result_meta(result = backend.encode_result(result, state),
+                                            state = state, traceback = None, request = None)
+            meta["task_id"] = task_id
+            encoded = backend.encode(meta)
+            if backend.expires:
+                pipe.setex(key, backend.expires, encoded)
+            else:
+                pipe.set(key, encoded)
+            pipe.publish(key, encoded)
+            written[task_id] = state
+            stored.append(task_id)
+        pipe.execute()
+
+    return stored, skipped
+
 def validate_apply_schema(data, schema_root = None, schema_path = None):
     """
     Validate the json schema of a request.
@@ -82,11 +270,14 @@ class TaskList(Resource):
     API endpoint to view a list all registered celery tasks.
 
 
-    list:  Return a list of all registered Tasks.
+    list:  Return a list of all registered Tasks, optionally filtered with the
+    plugin and queue query parameters.  Set detail=true to include the plugin
+    and queue of each task.
 
     """
-    def __init__(self, celery = None):
+    def __init__(self, celery = None, index = None):
         self.celery = celery
+        self.index = index
         super(TaskList, self).__init__()
 
 
@@ -95,7 +286,11 @@ class TaskList(Resource):
         """
         Return a list of all regiestered celery tasks.
         """
-        return [t for t in self.celery.tasks]
+        kind = "detail" if request.args.get("detail", "false").lower() == "true" else "tasks"
+        data, etag = self.index.filtered(kind,
+                                         plugin = request.args.get("plugin", None),
+                                         queue = request.args.get("queue", None))
+        return conditional_response(data, etag)
 
 class TaskRoutes(Resource):
     """
@@ -105,8 +300,9 @@ class TaskRoutes(Resource):
     list:  Return a list of all registered Tasks.
 
     """
-    def __init__(self, celery = None):
+    def __init__(self, celery = None, index = None):
         self.celery = celery
+        self.index = index
         super(TaskRoutes, self).__init__()
 
 
@@ -115,15 +311,20 @@ class TaskRoutes(Resource):
         """
         Return a list of all regiestered celery tasks.
         """
-        return self.celery.conf["task_routes"]
+        data, etag = self.index.filtered("routes",
+                                         plugin = request.args.get("plugin", None),
+                                         queue = request.args.get("queue", None))
+        return conditional_response(data, etag)
 
 class TaskApplyAsync(Resource):
     """
     API endpoint to view and/or execute Tasks.
 
     """
-    def __init__(self, celery = None):
+    def __init__(self, celery = None, pools = None, admission = None):
         self.celery = celery
+        self.pools = pools
+        self.admission = admission
         super(TaskApplyAsync, self).__init__()
 
 
@@ -135,13 +336,27 @@ class TaskApplyAsync(Resource):
         """
         try:
             logger.info("POST TaskApplyAsync " + task_name)
+            if self.admission is not None:
+                rejected = self.admission.admit(client_id(), task_name)
+                if rejected is not None:
+                    return rejected
+
             response, code  = validate_apply_schema(request.json,
-                                 schema_root = self.celery.conf["APTO_API_JSONSCHEMA_ROOT"],
-                                 schema_path = self.celery.conf["APTO_API_JSONSCHEMA_DEFAULT"])
+                                 schema_root = self.celery.conf["LABSTRO_API_JSONSCHEMA_ROOT"],
+                                 schema_path = self.celery.conf["LABSTRO_API_JSONSCHEMA_DEFAULT"])
             if code == 200:
-                r = self.celery.send_task(task_name,
-                     args = request.json.get("args", None),
-                     kwargs = request.json.get("kwargs", None))
+                options = {}
+                priority = task_priority(request.json,
+                     max_priority = self.celery.conf.get("LABSTRO_TASK_QUEUE_MAX_PRIORITY", None))
+                if priority is not None:
+                    options["priority"] = priority
+
+                with self.pools.producer() as producer:
+                    r = self.celery.send_task(task_name,
+                         args = request.json.get("args", None),
+                         kwargs = request.json.get("kwargs", None),
+                         producer = producer,
+                         **options)
                 
                 logger.info("sent task " + task_name)
                 return {"task-id":r.id, "state":r.state}, 200
@@ -156,8 +371,9 @@ class TaskApply(Resource):
     API endpoint to view and/or execute Tasks.
 
     """
-    def __init__(self, celery = None):
+    def __init__(self, celery = None, manifest = None):
         self.celery = celery
+        self.manifest = manifest
         super(TaskApply, self).__init__()
 
     def post(self, task_name):
@@ -167,9 +383,14 @@ class TaskApply(Resource):
         """
         try:
             response, code  = validate_apply_schema(request.json,
-                                 schema_root = self.celery.conf["APTO_API_JSONSCHEMA_ROOT"],
-                                 schema_path = self.celery.conf["APTO_API_JSONSCHEMA_DEFAULT"])
+                                 schema_root = self.celery.conf["LABSTRO_API_JSONSCHEMA_ROOT"],
+                                 schema_path = self.celery.conf["LABSTRO_API_JSONSCHEMA_DEFAULT"])
             if code == 200:
+                if task_name not in self.celery.tasks and self.manifest is not None:
+                    ## plugins listed in the manifest are imported on first use
+                    plugin = self.manifest.tasks().get(task_name, {}).get("plugin", None)
+                    if plugin:
+                        importlib.import_module(plugin)
                 TaskFunction = self.celery.tasks[task_name]
                 TaskSig = task_signature(TaskFunction, request.json) 
                 r = TaskSig.apply()
@@ -192,12 +413,7 @@ class TaskResult(Resource):
 
 
     def get(self, task_id):
-        r = self.celery.AsyncResult(task_id)
-        data = {"task_id": r.id,
-            "state": r.state,
-            "result": r.result,
-            "traceback": str(r.traceback)}
-        return data, 200
+        return task_result_data(self.celery.AsyncResult(task_id)), 200
 
 class TaskSuccess(Resource):
     """
@@ -211,12 +427,7 @@ class TaskSuccess(Resource):
 
     def post(self, task_id):
         self.celery.backend.mark_as_done(task_id, request.json)
-        r = self.celery.AsyncResult(task_id)
-        data = {"task_id": r.id,
-            "state": r.state,
-            "result": r.result,
-            "traceback": str(r.traceback)}
-        return data, 200
+        return task_transition_response(self.celery, task_id)
 
 class TaskStarted(Resource):
     """
@@ -230,21 +441,11 @@ class TaskStarted(Resource):
 
     def put(self, task_id):
         self.celery.backend.mark_as_started(task_id)
-        r = self.celery.AsyncResult(task_id)
-        data = {"task_id": r.id,
-            "state": r.state,
-            "result": r.result,
-            "traceback": str(r.traceback)}
-        return data, 200
+        return task_transition_response(self.celery, task_id)
     
     def post(self, task_id):
         self.celery.backend.mark_as_started(task_id)
-        r = self.celery.AsyncResult(task_id)
-        data = {"task_id": r.id,
-            "state": r.state,
-            "result": r.result,
-            "traceback": str(r.traceback)}
-        return data, 200
+        return task_transition_response(self.celery, task_id)
 
 class TaskFailed(Resource):
     """
@@ -258,34 +459,309 @@ class TaskFailed(Resource):
 
     def put(self, task_id):
         self.celery.backend.store_result(task_id, request.json, "FAILED", traceback = None)
-        r = self.celery.AsyncResult(task_id)
-        data = {"task_id": r.id,
-            "state": r.state,
-            "result": r.result,
-            "traceback": str(r.traceback)}
-        return data, 200
+        return task_transition_response(self.celery, task_id)
     
     def post(self, task_id):
 
         self.celery.backend.store_result(task_id, request.json, "FAILED", traceback = None)
-        r = self.celery.AsyncResult(task_id)
-        data = {"task_id": r.id,
-            "state": r.state,
-            "result": r.result,
-            "traceback": str(r.traceback)}
-        return data, 200
+        return task_transition_response(self.celery, task_id)
+
+class TaskBulkUpdate(Resource):
+    """
+    API endpoint to apply many task state transitions in one request e.g.::
+
+        {"transitions": [{"task_id": "...", "state": "started"},
+                         {"task_id": "...", "state": "success", "result": {...}},
+                         {"task_id": "...", "state": "failed", "result": {...}}],
+         "read_back": false}
+
+    """
+    def __init__(self, celery = None):
+        self.celery = celery
+        super(TaskBulkUpdate, self).__init__()
+
+
+    def post(self):
+        try:
+            data = request.json
+            transitions = [(t["task_id"], transition_state(t["state"]), t.get("result", None))
+                           for t in data["transitions"]]
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            return {"result": "invalid transitions", "exc":str(e)}, 400
+
+        stored, skipped = store_results(self.celery.backend, transitions)
+        logger.info("bulk update stored " + str(len(stored)) + " transitions")
+        response = {"stored": stored, "skipped": skipped}
+
+        if data.get("read_back", False):
+            response["results"] = [task_result_data(self.celery.AsyncResult(task_id))
+                                   for task_id in stored]
+        return response, 200
+
+class CampaignSubmit(Resource):
+    """
+    API endpoint to merge a campaign of protocols into one deduplicated
+    workflow and optionally dispatch it, e.g.::
+
+        {"protocols": {"qc-1": {...}, "qc-2": {...}},
+         "plugins": ["labstro.plugins.simulation"],
+         "campaign_id": "screen-42",
+         "dispatch": true}
+
+    """
+    def __init__(self, celery = None, manifest = None, admission = None):
+        self.celery = celery
+        self.manifest = manifest
+        self.admission = admission
+        super(CampaignSubmit, self).__init__()
+
+
+    def post(self):
+        data = request.json or {}
+        plugins = data.get("plugins", None)
+        if plugins is None and self.manifest is not None:
+            plugins = list(self.manifest.modules)
+
+        try:
+            compiler = CampaignCompiler(plugins, manifest = self.manifest)
+            plan = compiler.merge(data["protocols"])
+            if not plan.steps:
+                raise ValueError("the campaign has no instructions")
+            priority = task_priority(data,
+                 max_priority = self.celery.conf.get("LABSTRO_TASK_QUEUE_MAX_PRIORITY", None))
+            workflow = compiler.to_celery(plan, priority = priority,
+                                          campaign_id = data.get("campaign_id", None))
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            return {"result": "failed to compile campaign", "exc":str(e)}, 400
+
+        response = {"campaign_id": data.get("campaign_id", None),
+                    "stats": plan.stats(),
+                    "stages": plan.stages}
+        if data.get("dispatch", False):
+            if self.admission is not None:
+                ## every step of the campaign counts as a submission
+                rejected = self.admission.admit_many(client_id(), dict(signature_tasks(workflow)))
+                if rejected is not None:
+                    return rejected
+            r = workflow.apply_async()
+            logger.info("dispatched campaign " + str(response["campaign_id"]))
+            response["task-id"] = r.id
+        return response, 200
+
+class ProtocolSchedule(Resource):
+    """
+    API endpoint to plan protocols against their time_constraints and
+    instrument reservations, and optionally dispatch them with each
+    instruction released at its planned start, e.g.::
+
+        {"protocols": {"elisa-1": {...}, "elisa-2": {...}},
+         "plugins": ["labstro.plugins.simulation"],
+         "dispatch": true,
+         "strict": true}
+
+    With strict, nothing is dispatched and 409 is returned when a constraint
+    cannot be met.
+
+    """
+    def __init__(self, celery = None, manifest = None, scheduler = None):
+        self.celery = celery
+        self.manifest = manifest
+        self.scheduler = scheduler
+        super(ProtocolSchedule, self).__init__()
+
+
+    def post(self):
+        data = request.json or {}
+        plugins = data.get("plugins", None)
+        if plugins is None and self.manifest is not None:
+            plugins = list(self.manifest.modules)
+
+        dispatched = {}
+        def dispatch(schedule):
+            ## runs with the calendar locked, the instruments are reserved
+            ## when the workflow was sent
+            if not data.get("dispatch", False):
+                return False
+            if not schedule.feasible and data.get("strict", False):
+                return False
+            workflow = schedule.to_celery(plugins, manifest = self.manifest)
+            dispatched["task-id"] = workflow.apply_async().id
+            return True
+
+        try:
+            schedule = self.scheduler.schedule(data["protocols"], dispatch = dispatch)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            return {"result": "failed to schedule protocols", "exc":str(e)}, 400
+
+        response = schedule.as_dict()
+        if not schedule.feasible and data.get("strict", False):
+            return response, 409
+
+        if dispatched:
+            logger.info("dispatched schedule of " + str(sorted(data["protocols"])))
+            response.update(dispatched)
+        return response, 200
+
+class ProtocolTrace(Resource):
+    """
+    API endpoint to export the execution trace of a protocol submitted with
+    a protocol_id, as a Chrome trace / Perfetto timeline or, with
+    format=events, as the recorded events.
+
+    """
+    def __init__(self, trace_store = None):
+        self.trace_store = trace_store
+        super(ProtocolTrace, self).__init__()
+
+
+    def get(self, protocol_id):
+        events = self.trace_store.events(protocol_id)
+        if not events:
+            return {"result": "no trace for protocol " + protocol_id}, 404
+        if request.args.get("format", "chrome") == "events":
+            return events, 200
+        return chrome_trace(protocol_id, events), 200
+
+class ProtocolResults(Resource):
+    """
+    API endpoint to read the compacted results of a protocol, from its
+    summary record or from the archive.
+
+    """
+    def __init__(self, retention = None):
+        self.retention = retention
+        super(ProtocolResults, self).__init__()
+
+
+    def get(self, protocol_id):
+        summary, source = self.retention.lookup(protocol_id)
+        if summary is None:
+            return {"result": "no compacted results for protocol " + protocol_id}, 404
+        summary["source"] = source
+        return summary, 200
+
+class Retention(Resource):
+    """
+    API endpoint to view the retention settings, summaries and archive files
+    and, on POST, to compact and archive now e.g. {"protocol_id": "elisa-1"}
+    compacts one protocol regardless of its idle time.
+
+    """
+    def __init__(self, retention = None):
+        self.retention = retention
+        super(Retention, self).__init__()
+
+
+    def get(self):
+        return self.retention.stats(), 200
+
+    def post(self):
+        data = request.get_json(silent = True) or {}
+        if data.get("protocol_id", None) is not None:
+            return {"compacted": self.retention.compact(data["protocol_id"]), "archived": []}, 200
+        return self.retention.run(), 200
+
+class ProfileList(Resource):
+    """
+    API endpoint to list task profiles and change which tasks are profiled.
+    Profiles written by workers are only listed when LABSTRO_PROFILE_DIR is
+    a volume shared by the workers and the API.
+
+    """
+    def __init__(self, celery = None, profiler = None):
+        self.celery = celery
+        self.profiler = profiler
+        super(ProfileList, self).__init__()
+
+
+    def get(self):
+        return {"config": self.profiler.config(),
+                "profiles": self.profiler.list()}, 200
+
+    def put(self):
+        """
+        Profile tasks by name and/or sampling rate, e.g.
+        {"tasks": ["labstro.plugins.simulation.spin"], "sample_rate": 0.01},
+        the change is written to the shared profile directory, where the
+        worker pool processes read it, and broadcast to the workers.
+        """
+        data = request.get_json(silent = True)
+        if not isinstance(data, dict):
+            return {"result": "invalid profiling config", "exc": "expected a JSON object"}, 400
+        tasks = data.get("tasks", None)
+        sample_rate = data.get("sample_rate", None)
+        try:
+            config = self.profiler.configure(tasks = tasks, sample_rate = sample_rate)
+        except ValueError as e:
+            return {"result": "invalid profiling config", "exc":str(e)}, 400
+        self.celery.control.broadcast("labstro_profiling",
+                                      arguments = {"tasks": tasks, "sample_rate": sample_rate})
+        return {"config": config}, 200
+
+class Profile(Resource):
+    """
+    API endpoint to download a task profile, a cProfile stats file.
+
+    """
+    def __init__(self, profiler = None):
+        self.profiler = profiler
+        super(Profile, self).__init__()
+
+
+    def get(self, name):
+        path = self.profiler.path(name)
+        if path is None:
+            return {"result": "no profile " + name}, 404
+        response = send_file(os.path.abspath(path), mimetype = "application/octet-stream")
+        response.headers["Content-Disposition"] = "attachment; filename=" + name
+        return response
+
+class PoolStats(Resource):
+    """
+    API endpoint to view broker and backend connection pool statistics of
+    the serving process.
+
+    """
+    def __init__(self, pools = None):
+        self.pools = pools
+        super(PoolStats, self).__init__()
+
+
+    def get(self):
+        return self.pools.stats(), 200
+
 
 
+def setup_api(api, celery, pools = None, index = None, manifest = None,
+              admission = None, trace_store = None, profiler = None,
+              scheduler = None, retention = None):
+    if pools is None:
+        pools = ConnectionPools(celery)
+    if index is None:
+        index = TaskIndex(celery, manifest = manifest)
+    if scheduler is None:
+        scheduler = DeadlineScheduler.from_config(celery.conf)
 
-def setup_api(api, celery):
     ## setup API resource routing
-    api.add_resource(TaskList, '/apiv1/tasks', resource_class_kwargs = {"celery":celery})
-    api.add_resource(TaskRoutes, '/apiv1/task/routes', resource_class_kwargs = {"celery":celery})
+    api.add_resource(TaskList, '/apiv1/tasks', resource_class_kwargs = {"celery":celery, "index":index})
+    api.add_resource(TaskRoutes, '/apiv1/task/routes', resource_class_kwargs = {"celery":celery, "index":index})
     api.add_resource(TaskResult, '/apiv1/task/result/<task_id>', resource_class_kwargs = {"celery":celery})
     api.add_resource(TaskSuccess, '/apiv1/task/success/<task_id>', resource_class_kwargs = {"celery":celery})
     api.add_resource(TaskStarted, '/apiv1/task/started/<task_id>', resource_class_kwargs = {"celery":celery})
     api.add_resource(TaskFailed, '/apiv1/task/failed/<task_id>', resource_class_kwargs = {"celery":celery})
-    api.add_resource(TaskApply, '/apiv1/task/apply/<task_name>', resource_class_kwargs = {"celery":celery})
-    api.add_resource(TaskApplyAsync, '/apiv1/task/apply_async/<task_name>', resource_class_kwargs = {"celery":celery})
+    api.add_resource(TaskBulkUpdate, '/apiv1/task/bulk', resource_class_kwargs = {"celery":celery})
+    api.add_resource(TaskApply, '/apiv1/task/apply/<task_name>', resource_class_kwargs = {"celery":celery, "manifest":manifest})
+    api.add_resource(TaskApplyAsync, '/apiv1/task/apply_async/<task_name>', resource_class_kwargs = {"celery":celery, "pools":pools, "admission":admission})
+    api.add_resource(PoolStats, '/apiv1/pools', resource_class_kwargs = {"pools":pools})
+    api.add_resource(CampaignSubmit, '/apiv1/campaign', resource_class_kwargs = {"celery":celery, "manifest":manifest, "admission":admission})
+    api.add_resource(ProtocolSchedule, '/apiv1/schedule', resource_class_kwargs = {"celery":celery, "manifest":manifest, "scheduler":scheduler})
+    if profiler is not None:
+        api.add_resource(ProfileList, '/apiv1/profiles', resource_class_kwargs = {"celery":celery, "profiler":profiler})
+        api.add_resource(Profile, '/apiv1/profiles/<name>', resource_class_kwargs = {"profiler":profiler})
+    if trace_store is not None:
+        api.add_resource(ProtocolTrace, '/apiv1/protocol/trace/<protocol_id>', resource_class_kwargs = {"trace_store":trace_store})
+    if retention is not None:
+        api.add_resource(ProtocolResults, '/apiv1/protocol/results/<protocol_id>', resource_class_kwargs = {"retention":retention})
+        api.add_resource(Retention, '/apiv1/retention', resource_class_kwargs = {"retention":retention})
 
 
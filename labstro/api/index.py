@@ -0,0 +1,139 @@
+## Sean Landry
+
+import hashlib
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class TaskIndex():
+    """
+    Versioned snapshot of the registered celery tasks and task routes.
+
+    The snapshot is computed once and only rebuilt when the task names or
+    the task routes change, so the list and routes endpoints can answer
+    repeated polling from memory and with conditional 304 responses.
+
+    """
+
+    def __init__(self, celery, manifest = None):
+        """
+        Args:
+            celery (celery.Celery):  instance of a Celery application.
+
+        Kwargs:
+            manifest (labstro.manifest.PluginManifest):  plugin tasks that are
+                not imported by the API process.
+
+        """
+        self.celery = celery
+        self.manifest = manifest
+        self.version = 0
+        self._key = None
+        self._lock = threading.Lock()
+        self._filtered = {}
+
+    def _current_key(self):
+        ## a digest of the names and routes rather than their count or the
+        ## identity of the routes, which miss in place edits and swapped tasks
+        names = list(self.celery.tasks)
+        if self.manifest is not None:
+            names.extend(self.manifest.tasks())
+        body = json.dumps([sorted(names), self.celery.conf["task_routes"] or {}],
+                          sort_keys = True, default = str)
+        return hashlib.sha1(body.encode("utf-8")).hexdigest()
+
+    def _queue(self, name):
+        try:
+            queue = self.celery.amqp.router.route({}, name).get("queue", None)
+        except Exception as e:
+            logger.warning("unable to route " + name + ": " + str(e))
+            return None
+        return getattr(queue, "name", queue)
+
+    def invalidate(self):
+        """
+        Force a rebuild on next access.
+        """
+        with self._lock:
+            self._key = None
+
+    def snapshot(self):
+        """
+        Return the current snapshot, rebuilding it if tasks were registered
+        since it was computed.
+
+        Returns:
+            (dict):  {"version": int, "etag": str, "tasks": [...], "routes": {...}}
+
+        """
+        key = self._current_key()
+        if key == self._key:
+            return self._snapshot
+
+        with self._lock:
+            if key != self._key:
+                self._build(key)
+        return self._snapshot
+
+    def _build(self, key):
+        names = set(self.celery.tasks)
+        if self.manifest is not None:
+            names.update(self.manifest.tasks())
+
+        tasks = [{"name": n,
+                  "plugin": n.rsplit(".", 1)[0] if "." in n else None,
+                  "queue": self._queue(n)}
+                 for n in sorted(names)]
+        routes = self.celery.conf["task_routes"] or {}
+
+        body = json.dumps({"tasks": tasks, "routes": routes}, sort_keys = True, default = str)
+        self.version += 1
+        self._snapshot = {"version": self.version,
+                          "etag": hashlib.sha1(body.encode("utf-8")).hexdigest(),
+                          "tasks": tasks,
+                          "routes": routes}
+        self._filtered = {}
+        self._key = key
+        logger.info("built task index version " + str(self.version))
+
+    def filtered(self, kind, plugin = None, queue = None):
+        """
+        Return the tasks or routes of the snapshot matching a plugin and/or
+        queue, along with their etag.  Results are memoized per snapshot.
+
+        Args:
+            kind (str):  "tasks", "detail" or "routes".
+
+        Kwargs:
+            plugin (str):  module path of a plugin e.g. "labstro.plugins.simulation".
+
+            queue (str):  name of a queue e.g. "labstro-simulation".
+
+        Returns:
+            (list or dict, str):  data, etag
+
+        """
+        snapshot = self.snapshot()
+        cache_key = (kind, plugin, queue)
+        if cache_key in self._filtered:
+            return self._filtered[cache_key]
+
+        if kind == "routes":
+            data = {k: v for k, v in snapshot["routes"].items()
+                    if (plugin is None or k.startswith(plugin))
+                    and (queue is None or v.get("queue", None) == queue)}
+        else:
+            data = [t for t in snapshot["tasks"]
+                    if (plugin is None or t["plugin"] == plugin)
+                    and (queue is None or t["queue"] == queue)]
+            if kind == "tasks":
+                data = [t["name"] for t in data]
+
+        etag = snapshot["etag"] + "-" + hashlib.sha1(repr(cache_key).encode("utf-8")).hexdigest()[:8]
+
+        self._filtered[cache_key] = (data, etag)
+        return data, etag
@@ -1,64 +1,26 @@
 # -*- coding: utf-8 -*-
 
 ## Sean Landry
-from flask import Flask, escape, request
-from celery import Celery
+from flask import escape, request
+from celery.signals import celeryd_after_setup
 import logging
 from flask_restful import Api
 from .api import apiv1
+from .factory import make_celery, make_flask
+from .pools import ConnectionPools
+from .serializers import setup_celery, setup_flask
+from .api.index import TaskIndex
+from .api.admission import AdmissionControl
+from .manifest import PluginManifest
+from .tracing import RedisTraceStore, Tracer
+from .retention import ResultRetention
+from .routing import RouteRefresher, worker_queues, pin_worker
 from flask.logging import default_handler
 
 root = logging.getLogger()
 root.addHandler(default_handler)
 root.setLevel(logging.INFO)
 
-def make_celery(app):
-    """
-    Instantiate and configure a Celery application using a Flask configuration.
-
-    Args:
-        app (flask.Flask): instance of a Flask application.
-
-    Returns:
-        celery (celery.Celery): instance of a Celery application.
-
-    """
-    celery = Celery(
-        app.import_name
-    )
-    celery.config_from_object(app.config, namespace='LABSTRO')
-
-    class ContextTask(celery.Task):
-        def __call__(self, *args, **kwargs):
-            with app.app_context():
-                return self.run(*args, **kwargs)
-
-    celery.Task = ContextTask
-    return celery
-
-def make_flask(config_obj="labstro.config.settings.default",
-               user_config_obj="labstro.config.settings.user.default",
-               app_name = "labstro"):
-    """
-    Instantiate and configure a Flask application.
-
-    Kwargs:
-        config_obj (str):  python module containing flask settings.
-
-        user_config_obj (str):  python module containing user defined flask settings.
-
-        app_name (str):  name given to flask application.
-
-    """
-
-    ## setup flask app
-    app = Flask(app_name)
-    app.config.from_object(config_obj)
-    app.config.from_object(user_config_obj)
-
-    return app
-
-
 ## setup flask app
 app = make_flask()
 
@@ -70,17 +32,72 @@ api = Api(app)
 
 ## setup celery
 celery = make_celery(app)
-celery.loader.import_default_modules()
-app.logger.info("registered routes: " + str(celery.conf["LABSTRO_TASK_ROUTES"]))
-app.logger.info("including: " + str(celery.conf["LABSTRO_INCLUDE"]))
-
-apiv1.setup_api(api, celery)
+serializer = setup_celery(celery, app.config["LABSTRO_SERIALIZER"])
+setup_flask(api, serializer)
+
+## discover plugins through the manifest, plugin modules are imported by the
+## workers executing their tasks rather than at API startup
+manifest = PluginManifest(app.config["LABSTRO_PLUGIN_MANIFEST"],
+                          plugins = app.config["LABSTRO_PLUGINS"] + app.config["LABSTRO_SIMULATION_PLUGINS"],
+                          group = app.config["LABSTRO_PLUGIN_ENTRY_POINT_GROUP"]).refresh()
+celery.conf["include"] = list(celery.conf["include"]) + [m for m in manifest.modules
+                                                         if m not in celery.conf["include"]]
+
+## one route and queue per instrument or plugin, regenerated when plugins
+## are added while the API runs
+routes = RouteRefresher(celery, manifest, prefix = app.config["LABSTRO_QUEUE_PREFIX"],
+                        static = app.config["LABSTRO_TASK_ROUTES"],
+                        max_priority = app.config["LABSTRO_TASK_QUEUE_MAX_PRIORITY"],
+                        interval = app.config["LABSTRO_PLUGIN_REFRESH_INTERVAL"])
+routes.apply()
+## written only when the generated queues differ from the saved manifest
+manifest.save()
+
+@app.before_request
+def refresh_routes():
+    routes.maybe_refresh()
+app.logger.info("registered routes: " + str(celery.conf.task_routes))
+app.logger.info("including: " + str(celery.conf["include"]))
+
+## share broker producers and backend clients across requests, the pools
+## are reset in each gunicorn worker after fork
+pools = ConnectionPools(celery)
+
+## precompute the task list and routes served to polling clients
+index = TaskIndex(celery, manifest = manifest)
+index.snapshot()
+
+## token bucket rate limits and queue depth backpressure on submissions
+admission = AdmissionControl.from_config(celery)
+
+## record when protocol instructions are queued, started and finished, in
+## the API and the workers
+trace_store = RedisTraceStore.from_url(app.config["LABSTRO_TRACE_REDIS_URL"],
+                                       ttl = app.config["LABSTRO_TRACE_TTL"])
+if app.config["LABSTRO_TRACE_ENABLED"]:
+    Tracer(trace_store).connect()
+
+## expire results per task and queue, compact traced protocols into summaries
+## and archive old summaries, maintained by the labstro.retention.maintain task
+retention = ResultRetention.from_config(celery, trace_store).connect()
+celery.labstro_retention = retention
+
+apiv1.setup_api(api, celery, pools = pools, index = index, manifest = manifest,
+                admission = admission, trace_store = trace_store,
+                profiler = celery.labstro_profiler, retention = retention)
 
 @app.route('/')
 def hello():
     name = request.args.get("name", "World")
     return f'Hello, {escape(name)}!'
 
+@celeryd_after_setup.connect
+def pin_worker_queues(sender, instance, **kwargs):
+    plugins = app.config["LABSTRO_WORKER_PLUGINS"]
+    if plugins:
+        pin_worker(instance.app, worker_queues(manifest, plugins,
+                                               prefix = app.config["LABSTRO_QUEUE_PREFIX"]))
+
 @celery.task(bind=True)
 def debug_task(self):
     print('Request: {0!r}'.format(self.request))
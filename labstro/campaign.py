@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+"""Compile campaigns of related protocols into one deduplicated workflow."""
+
+from celery import chain, group, signature
+import json
+import logging
+
+from .labstro import AutoprotocolToCelery
+from .tracing import trace_headers
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+## separates the protocol id of a renamed private ref from the ref name, it
+## must differ from the "/" separating a ref from a well
+RENAME_SEPARATOR = ":"
+
+
+def _ref_of(value, refs):
+    """
+    Return the ref named by a string, a bare ref name or a well "ref name/A1",
+    matching whole ref names.
+    """
+    if value in refs:
+        return value
+    ref = value.rpartition("/")[0]
+    while ref:
+        if ref in refs:
+            return ref
+        ref = ref.rpartition("/")[0]
+    return None
+
+
+def _rename(value, names):
+    """
+    Rename the refs referenced by an instruction, refs appear as a bare ref
+    name or as a well "ref name/A1".
+    """
+    if isinstance(value, dict):
+        return {k: _rename(v, names) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_rename(v, names) for v in value]
+    if isinstance(value, str):
+        ref = _ref_of(value, names)
+        if ref is not None:
+            return names[ref] + value[len(ref):]
+    return value
+
+
+def _touched(value, refs, found = None):
+    """
+    Return the ref names referenced by an instruction.
+    """
+    found = set() if found is None else found
+    if isinstance(value, dict):
+        for v in value.values():
+            _touched(v, refs, found)
+    elif isinstance(value, list):
+        for v in value:
+            _touched(v, refs, found)
+    elif isinstance(value, str):
+        ref = _ref_of(value, refs)
+        if ref is not None:
+            found.add(ref)
+    return found
+
+
+class CampaignPlan():
+    """
+    Merged plan of a campaign.
+
+    Attributes:
+        refs (dict):  merged Autoprotocol refs.
+
+        steps (list):  unique steps, each a dict with the instruction, the refs
+            it touches, the protocols it serves and the indices of the steps
+            it depends on.
+
+        stages (list):  lists of step indices, every step of a stage only
+            depends on steps of earlier stages.
+
+    """
+
+    def __init__(self, refs, steps, instruction_count):
+        self.refs = refs
+        self.steps = steps
+        self.instruction_count = instruction_count
+        self.stages = self._stages()
+
+    def _stages(self):
+        level = {}
+        for s in self.steps:
+            level[s["index"]] = 1 + max([level[d] for d in s["depends"]] or [-1])
+        stages = [[] for _ in range(max(level.values()) + 1)] if level else []
+        for index, l in sorted(level.items()):
+            stages[l].append(index)
+        return stages
+
+    def stats(self):
+        """
+        Return the number of submitted instructions, unique steps, deduplicated
+        steps and stages.
+        """
+        return {"instructions": self.instruction_count,
+                "steps": len(self.steps),
+                "deduplicated": self.instruction_count - len(self.steps),
+                "stages": len(self.stages)}
+
+    def as_dict(self):
+        return {"refs": self.refs, "steps": self.steps, "stages": self.stages,
+                "stats": self.stats()}
+
+
+class CampaignCompiler():
+    """
+    Merge many protocols into one plan.
+
+    Refs with the same container id are shared across protocols, other refs
+    are private and renamed "<protocol id>:<ref name>" when their name is
+    already taken.  An instruction acting only on shared containers is
+    executed once when another protocol performs the identical instruction
+    after the identical history on those containers, e.g. every protocol
+    spinning down the same reagent plate first.  The remaining steps of all
+    protocols are interleaved in stages that run concurrently.
+
+    """
+
+    def __init__(self, plugins, manifest = None):
+        """
+        Args:
+            plugins (list): plugins to use for routing operations e.g. ["labstro.plugins.simulation"]
+
+        Kwargs:
+            manifest (labstro.manifest.PluginManifest):  route from the
+                manifest instead of importing the plugins.
+
+        """
+        self.plugins = plugins
+        self.manifest = manifest
+
+    def _merge_refs(self, protocols):
+        refs = {}
+        names = {}
+        shared = set()
+        by_id = {}
+        for pid, protocol in protocols.items():
+            names[pid] = {}
+            for name, spec in protocol["refs"].items():
+                cid = spec.get("id", None)
+                if cid is not None and cid in by_id:
+                    names[pid][name] = by_id[cid]
+                    shared.add(by_id[cid])
+                    continue
+
+                merged = name if name not in refs else RENAME_SEPARATOR.join([str(pid), name])
+                refs[merged] = spec
+                names[pid][name] = merged
+                if cid is not None:
+                    by_id[cid] = merged
+        return refs, names, shared
+
+    def merge(self, protocols):
+        """
+        Merge protocols into a plan.
+
+        Args:
+            protocols (dict):  map of a protocol id to an Autoprotocol dict.
+
+        Returns:
+            (CampaignPlan)
+
+        """
+        refs, names, shared = self._merge_refs(protocols)
+
+        steps = []
+        seen = {}
+        ## last step applied to each container
+        last = {}
+        count = 0
+        for pid, protocol in protocols.items():
+            ## history of each container as seen by this protocol
+            history = {}
+            ## steps the next step of this protocol must follow, its last own
+            ## step and the steps merged into other protocols since
+            previous = set()
+            for i in protocol["instructions"]:
+                count += 1
+                instruction = _rename(i, names[pid])
+                touched = sorted(_touched(instruction, refs))
+                key = None
+                if touched and all(r in shared for r in touched):
+                    key = (json.dumps(instruction, sort_keys = True),
+                           tuple(tuple(history.get(r, ())) for r in touched))
+
+                if key is not None and key in seen:
+                    step = steps[seen[key]]
+                    step["protocols"].append(pid)
+                else:
+                    depends = set(last.get(r) for r in touched if r in shared and r in last)
+                    depends.update(previous)
+                    step = {"index": len(steps),
+                            "op": instruction["op"],
+                            "instruction": instruction,
+                            "refs": touched,
+                            "protocols": [pid],
+                            "depends": sorted(d for d in depends if d is not None)}
+                    steps.append(step)
+                    if key is not None:
+                        seen[key] = step["index"]
+
+                if step["protocols"][0] == pid:
+                    previous = {step["index"]}
+                else:
+                    previous.add(step["index"])
+                for r in touched:
+                    history.setdefault(r, []).append(step["index"])
+                    if r in shared:
+                        last[r] = max(last.get(r, -1), step["index"])
+
+        plan = CampaignPlan(refs, steps, count)
+        logger.info("merged campaign: " + str(plan.stats()))
+        return plan
+
+    def to_celery(self, plan, priority = None, campaign_id = None):
+        """
+        Translate a plan into a celery workflow, a chain of stages where each
+        stage is a group of independent steps.  Steps only receive the refs
+        they act on.
+
+        Args:
+            plan (CampaignPlan):  merged plan.
+
+        Kwargs:
+            priority (int):  message priority of every step.
+
+            campaign_id (str):  trace the campaign, the step index is used as
+                instruction index.
+
+        Returns:
+            celery.canvas.Signature
+
+        """
+        operations = [s["op"] for s in plan.steps]
+        plugin_dict = AutoprotocolToCelery.route_plugins(operations, self.plugins,
+                                                         manifest = self.manifest)
+        sigs = []
+        for s in plan.steps:
+            args = ({r: plan.refs[r] for r in s["refs"]}, s["instruction"])
+            if self.manifest is not None:
+                sig = signature(plugin_dict[s["op"]][0], args = args, immutable = True)
+            else:
+                sig = AutoprotocolToCelery.import_task(s["op"], plugin_dict).si(*args)
+            if priority is not None:
+                sig = sig.set(priority = priority)
+            if campaign_id is not None:
+                sig = sig.set(headers = trace_headers(campaign_id, s["index"]))
+            sigs.append(sig)
+
+        stages = [group([sigs[i] for i in stage]) if len(stage) > 1 else sigs[stage[0]]
+                  for stage in plan.stages]
+        return chain(stages)
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+"""Container registry used to resolve and index Autoprotocol refs."""
+
+from functools import lru_cache
+import json
+import logging
+
+from autoprotocol.container import Container
+from autoprotocol.container_type import ContainerType, _CONTAINER_TYPES
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+@lru_cache(maxsize=None)
+def load_catalog(path):
+    """
+    Load a catalog of plate definitions from a JSON file.  The parsed catalog
+    is cached per path so repeated loads are free.
+
+    Args:
+        path (str):  file path to a JSON object mapping a container type
+            shortname to the keyword arguments of a
+            autoprotocol.container_type.ContainerType e.g.::
+
+                {"96-custom": {"name": "96-well custom plate",
+                               "well_count": 96,
+                               ...}}
+
+    Returns:
+        (dict):  a map of shortname to autoprotocol.container_type.ContainerType.
+
+    """
+    with open(path, "r") as f:
+        definitions = json.load(f)
+    return {k: ContainerType(**v) for k, v in definitions.items()}
+
+
+@lru_cache(maxsize=None)
+def load_inventory(path):
+    """
+    Load an inventory of existing containers from a JSON file.  The parsed
+    inventory is cached per path.
+
+    Args:
+        path (str):  file path to a JSON object mapping a container id to its
+            container type shortname e.g.::
+
+                {"ct1abc": "96-pcr", "ct1abd": "micro-1.5"}
+
+    Returns:
+        (dict):  a map of container id to container type shortname.
+
+    """
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+class ContainerRegistry():
+    """
+    Index of autoprotocol.container.Container objects by name, id and
+    storage location.  Container types are resolved from a catalog of plate
+    definitions, by default the catalog shipped with autoprotocol, and the
+    types of existing containers from an inventory keyed by container id.
+
+    """
+
+    def __init__(self, catalog = None, inventory = None):
+        """
+        Kwargs:
+            catalog (dict or str):  map of shortname to
+                autoprotocol.container_type.ContainerType, or a file path
+                accepted by load_catalog.  Entries extend the default catalog.
+
+            inventory (dict or str):  map of container id to container type
+                shortname, or a file path accepted by load_inventory.
+
+        """
+        self.catalog = dict(_CONTAINER_TYPES)
+        if isinstance(catalog, str):
+            catalog = load_catalog(catalog)
+        if catalog:
+            self.catalog.update(catalog)
+
+        if isinstance(inventory, str):
+            inventory = load_inventory(inventory)
+        self.inventory = dict(inventory or {})
+
+        ## refs whose container type could not be resolved, by ref name
+        self.unresolved = {}
+        self._by_name = {}
+        self._by_id = {}
+        self._by_storage = {}
+
+    def __len__(self):
+        return len(self._by_name)
+
+    def __iter__(self):
+        return iter(self._by_name.values())
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def container_type(self, cont_type):
+        """
+        Resolve a container type.
+
+        Args:
+            cont_type (str or autoprotocol.container_type.ContainerType):
+                shortname of a catalog entry or an already resolved type.
+
+        Returns:
+            (autoprotocol.container_type.ContainerType)
+
+        """
+        if isinstance(cont_type, ContainerType):
+            return cont_type
+        try:
+            return self.catalog[cont_type]
+        except KeyError:
+            raise ValueError("unknown container type: " + str(cont_type))
+
+    def add(self, container):
+        """
+        Register a container in every index.
+
+        Args:
+            container (autoprotocol.container.Container):  container to add.
+
+        Returns:
+            (autoprotocol.container.Container): the registered container.
+
+        """
+        previous = self._by_name.get(container.name, None)
+        if previous is not None and previous.id and self._by_id.get(previous.id, None) is previous:
+            del self._by_id[previous.id]
+        if previous is not None and previous.storage:
+            self._by_storage[previous.storage].remove(previous)
+
+        self._by_name[container.name] = container
+        if container.id:
+            self._by_id[container.id] = container
+        if container.storage:
+            self._by_storage.setdefault(container.storage, []).append(container)
+        return container
+
+    def get(self, name, default = None):
+        """
+        Return a container by ref name.
+        """
+        return self._by_name.get(name, default)
+
+    def get_by_id(self, container_id, default = None):
+        """
+        Return a container by id.
+        """
+        return self._by_id.get(container_id, default)
+
+    def in_storage(self, where):
+        """
+        Return all containers stored at a location e.g. "cold_4".
+        """
+        return list(self._by_storage.get(where, []))
+
+    def resolve_ref(self, name, opts):
+        """
+        Create and register a container from an Autoprotocol ref.
+
+        The container type is taken from "new" when present, then an
+        explicit "cont_type", then from a previously registered container
+        sharing the same id, and finally from the inventory.
+
+        Args:
+            name (str):  ref name.
+
+            opts (dict):  ref options e.g.::
+
+                {"new": "96-pcr", "discard": true}
+
+        Returns:
+            (autoprotocol.container.Container)
+
+        """
+        cont_type = opts.get("new", None) or opts.get("cont_type", None)
+        if not cont_type:
+            known = self.get_by_id(opts.get("id", None))
+            if known is not None:
+                cont_type = known.container_type
+            else:
+                cont_type = self.inventory.get(opts.get("id", None), None)
+            if not cont_type:
+                raise ValueError("unable to resolve container type for ref: " + name)
+
+        storage = opts.get("store", None)
+        if storage:
+            storage = storage["where"]
+
+        c = Container(opts.get("id", None), self.container_type(cont_type),
+                      name = name,
+                      storage = storage,
+                      cover = opts.get("cover", None))
+        self.unresolved.pop(name, None)
+        return self.add(c)
+
+    def try_resolve_ref(self, name, opts):
+        """
+        Like resolve_ref, but a ref of an existing container whose type is
+        unknown is kept in unresolved instead of failing the whole load.
+
+        Returns:
+            (autoprotocol.container.Container):  None when unresolved.
+
+        """
+        try:
+            return self.resolve_ref(name, opts)
+        except ValueError as e:
+            if opts.get("new", None) or opts.get("cont_type", None):
+                ## an unknown type was named explicitly
+                raise
+            logger.warning(str(e))
+            self.unresolved[name] = opts
+            return None
+
+    @classmethod
+    def from_refs(cls, refs, catalog = None, inventory = None):
+        """
+        Build a registry from the "refs" section of an Autoprotocol dict, as
+        received by plugin tasks.  Refs of existing containers that are not
+        in the inventory are left in unresolved.
+
+        Args:
+            refs (dict):  Autoprotocol refs.
+
+        Kwargs:
+            catalog (dict or str):  see ContainerRegistry.
+
+            inventory (dict or str):  see ContainerRegistry.
+
+        Returns:
+            (ContainerRegistry)
+
+        """
+        registry = cls(catalog = catalog, inventory = inventory)
+        for k, v in refs.items():
+            registry.try_resolve_ref(k, v)
+        return registry
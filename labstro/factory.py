@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+"""Flask and Celery application factories."""
+
+from celery import Celery
+from flask import Flask
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from .profiling import TaskProfiler
+
+
+def make_celery(app):
+    """
+    Instantiate and configure a Celery application using a Flask configuration.
+
+    Args:
+        app (flask.Flask): instance of a Flask application.
+
+    Returns:
+        celery (celery.Celery): instance of a Celery application.
+
+    """
+    celery = Celery(
+        app.import_name
+    )
+    celery.config_from_object(app.config, namespace='LABSTRO')
+
+    ## opt-in profiling, reconfigured on running workers with
+    ## celery.control.broadcast("labstro_profiling", ...)
+    profiler = TaskProfiler.from_config(app.config)
+    celery.labstro_profiler = profiler
+
+    class ContextTask(celery.Task):
+        def __call__(self, *args, **kwargs):
+            with app.app_context():
+                if profiler.enabled and profiler.should_profile(self.name):
+                    return profiler.run(self.name, self.request.id, self.run, *args, **kwargs)
+                return self.run(*args, **kwargs)
+
+    celery.Task = ContextTask
+    return celery
+
+def make_flask(config_obj="labstro.config.settings.default",
+               user_config_obj="labstro.config.settings.user.default",
+               app_name = "labstro"):
+    """
+    Instantiate and configure a Flask application.
+
+    Kwargs:
+        config_obj (str):  python module containing flask settings.
+
+        user_config_obj (str):  python module containing user defined flask settings.
+
+        app_name (str):  name given to flask application.
+
+    """
+
+    ## setup flask app
+    app = Flask(app_name)
+    app.config.from_object(config_obj)
+    app.config.from_object(user_config_obj)
+
+    ## admission control identifies clients by address, trust the
+    ## X-Forwarded-For of the configured number of reverse proxies
+    if app.config.get("LABSTRO_ADMISSION_PROXY_COUNT", 0):
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for = app.config["LABSTRO_ADMISSION_PROXY_COUNT"])
+
+    return app
@@ -2,12 +2,14 @@
 
 """Main module."""
 
-from celery import chain, shared_task
+from celery import chain, shared_task, signature
 from celery.utils.log import get_task_logger
 from copy import copy
 import importlib
 import json
 from autoprotocol.protocol import Ref, Protocol
+from .containers import ContainerRegistry
+from .tracing import trace_headers
 ## grab the celery task logger
 logger = get_task_logger(__name__)
 
@@ -40,46 +42,37 @@ class AutoprotocolToCelery():
 
 
     @staticmethod
-    def from_json(path):
+    def from_json(path, registry = None):
         """
         Load an Autoprotocol formatted JSON.
 
         Args:
             path (str):  file path.
 
+        Kwargs:
+            registry (labstro.containers.ContainerRegistry):  registry used to
+                resolve container types and index the loaded containers, a new
+                registry is created if not provided.
+
         Returns:
-            [autoprotocol.container.Container], autoprotocol.protocol.Protocol
+            labstro.containers.ContainerRegistry, autoprotocol.protocol.Protocol
         """
-        containers = []
+        if registry is None:
+            registry = ContainerRegistry()
+
         with open(path, "r") as f:
             p_dict = json.load(f)
             p = Protocol()
             for k,v in p_dict["refs"].items():
 
-                ## get storage info
-
-                storage = v.get("store", None)
-                if storage:
-                    storage = v["store"]["where"]
+                ## cont_type is not available in spec unless it is a "new"
+                ## container, the registry falls back to a known container
+                ## with the same id and then to its inventory, refs still
+                ## unresolved are left in registry.unresolved
+                c = registry.try_resolve_ref(k, v)
+                if c is None:
+                    continue
 
-                
-                ## cont_type is not available in spec unless it is a "new" 
-                ## container e.g,
-                ##
-                ## "sample_plate_1": {
-                ##   "new": "96-pcr",
-                ##   "discard": true
-                ## }
-
-                cont_type = v.get("new", None)
-
-                ## create container, this will break without cont_type
-                c =  Container(v.get("id", None), cont_type, name = k,
-                               storage = storage,
-                               cover = v.get("cover", None))
-
-                containers.append(c)
-                
                 ## create Ref and add to protocol
                 r = Ref(k, v, c)
 
@@ -93,10 +86,10 @@ class AutoprotocolToCelery():
 
                 ## p._append_and_return(Instruction)
 
-        return containers, p
+        return registry, p
 
     @staticmethod
-    def route_plugins(operations, plugins):
+    def route_plugins(operations, plugins, manifest = None):
         """
         Establish the routes to the corresponding plugins as requested by the
         operations.
@@ -105,6 +98,10 @@ class AutoprotocolToCelery():
             operations (list): a list of operations e.g., ["seal", "spin"]
     
             plugins (list): a list of plugins to import e.g. ["apto.plugins.simulation"]
+
+        Kwargs:
+            manifest (labstro.manifest.PluginManifest):  route from the
+                manifest instead of importing the plugins.
     
     
         Returns:
@@ -114,6 +111,12 @@ class AutoprotocolToCelery():
                  "spin": ["apto.plugins.simulation.spin"]
     
         """
+        if manifest is not None:
+            rmap = manifest.route(operations, plugins)
+            for o, r in rmap.items():
+                logger.info("routing " + o + " to " + ", ".join(r))
+            return rmap
+
         plugins = [importlib.import_module(p) for p in plugins]
         rmap = {}
     
@@ -122,7 +125,7 @@ class AutoprotocolToCelery():
                 if hasattr(p, o):
                     r = ".".join([p.__name__,o])
                     if rmap.get(o):
-                        rmap[0].append(r)
+                        rmap[o].append(r)
                     else:
                         rmap[o] = [r]
                     logger.info("routing " + o + " to " + r)
@@ -131,7 +134,8 @@ class AutoprotocolToCelery():
  
     
     
-    def to_celery(self, protocol, plugins):
+    def to_celery(self, protocol, plugins, priority = None, manifest = None,
+                  protocol_id = None):
         """
         Translate Autoprotocol instructions into schedulable workflows
         using celery canvas.  Currently, a protocol is simple transformed to
@@ -174,10 +178,32 @@ class AutoprotocolToCelery():
 
 
             plugins (list): plugins to use for routing operations e.g. ["apto.plugins.simulation"]
+
+        Kwargs:
+            priority (int):  message priority applied to every task of the
+                protocol, higher values are consumed first from priority queues
+                (see LABSTRO_TASK_QUEUE_MAX_PRIORITY).
+
+            manifest (labstro.manifest.PluginManifest):  build signatures by
+                task name from the manifest, plugins are then only imported by
+                the workers executing the tasks.
+
+            protocol_id (str):  identifier propagated with the instruction
+                index in the task headers, executions are then traced by
+                labstro.tracing.Tracer.
     
         """
         operations = [i["op"] for i in protocol["instructions"]]
-        plugin_dict = self.route_plugins(operations, plugins)
-    
-        return chain([self.import_task(i["op"], plugin_dict).s(protocol["refs"], i) for i in protocol["instructions"]])
+        plugin_dict = self.route_plugins(operations, plugins, manifest = manifest)
+
+        if manifest is not None:
+            sigs = [signature(plugin_dict[i["op"]][0], args = (protocol["refs"], i)) for i in protocol["instructions"]]
+        else:
+            sigs = [self.import_task(i["op"], plugin_dict).s(protocol["refs"], i) for i in protocol["instructions"]]
+        if priority is not None:
+            sigs = [s.set(priority = priority) for s in sigs]
+        if protocol_id is not None:
+            sigs = [s.set(headers = trace_headers(protocol_id, n)) for n, s in enumerate(sigs)]
+    
+        return chain(sigs)
 
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+
+"""Load generator for the apiv1 endpoints."""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+import uuid
+
+import click
+from flask_restful import Api
+
+from .api import apiv1
+from .api.admission import AdmissionControl
+from .factory import make_celery, make_flask
+from .pools import ConnectionPools
+from .serializers import setup_celery, setup_flask
+from .tracing import LocalTraceStore, Tracer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+CONFIG_ROOT = os.path.join(os.path.dirname(__file__), "config")
+
+## settings of the stand-in application, the broker and result backend are
+## in memory, admission control is kept with limits no load test reaches so
+## its cost is measured without rejecting requests
+STANDIN_CONFIG = {"LABSTRO_BROKER_URL": "memory://",
+                  "LABSTRO_CELERY_RESULT_BACKEND": "cache+memory://",
+                  "LABSTRO_API_JSONSCHEMA_ROOT": CONFIG_ROOT,
+                  "LABSTRO_ADMISSION_BACKEND": "local",
+                  "LABSTRO_ADMISSION_CLIENT_RATE": 1e9,
+                  "LABSTRO_ADMISSION_CLIENT_BURST": 10 ** 9,
+                  "LABSTRO_ADMISSION_TASK_RATE": 1e9,
+                  "LABSTRO_ADMISSION_TASK_BURST": 10 ** 9,
+                  "LABSTRO_ADMISSION_MAX_QUEUE_DEPTH": 10 ** 9}
+
+
+def percentile(values, q):
+    """
+    Return the q-th percentile of values by the nearest rank method.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(math.ceil(q / 100.0 * len(values))), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+class LatencyRecorder():
+    """
+    Collect latencies in seconds per name, from many threads.
+    """
+
+    def __init__(self):
+        self._samples = {}
+        self._errors = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, error = False):
+        with self._lock:
+            self._samples.setdefault(name, []).append(seconds)
+            if error:
+                self._errors[name] = self._errors.get(name, 0) + 1
+
+    def timed(self, name, fun):
+        """
+        Wrap fun so every call is recorded under name.
+        """
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fun(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - start)
+        return wrapper
+
+    def summary(self, duration):
+        """
+        Return {name: {"count", "errors", "throughput", "mean", "p50", "p99"}},
+        latencies in milliseconds and throughput in calls per second.
+        """
+        with self._lock:
+            samples = {k: list(v) for k, v in self._samples.items()}
+            errors = dict(self._errors)
+
+        def ms(s):
+            return None if s is None else round(s * 1000.0, 3)
+
+        return {name: {"count": len(v),
+                       "errors": errors.get(name, 0),
+                       "throughput": round(len(v) / duration, 1) if duration else None,
+                       "mean": ms(sum(v) / len(v)),
+                       "p50": ms(percentile(v, 50)),
+                       "p99": ms(percentile(v, 99))}
+                for name, v in sorted(samples.items())}
+
+
+def standin_app(config = None):
+    """
+    Build the API the way labstro.app does, with its settings, serializer,
+    connection pools, admission control and tracer, but with the in-memory
+    kombu transport in place of RabbitMQ and the in-memory cache backend in
+    place of Redis, so load tests need no services.
+
+    The tracer is kept as celery.labstro_tracer, disconnect it once done.
+
+    Kwargs:
+        config (dict):  settings overriding STANDIN_CONFIG.
+
+    Returns:
+        (flask.Flask, celery.Celery)
+
+    """
+    app = make_flask(app_name = "labstro-loadtest")
+    app.config.update(STANDIN_CONFIG)
+    app.config.update(config or {})
+
+    api = Api(app)
+    celery = make_celery(app)
+    setup_flask(api, setup_celery(celery, app.config["LABSTRO_SERIALIZER"]))
+
+    trace_store = LocalTraceStore()
+    celery.labstro_tracer = Tracer(trace_store)
+    if app.config["LABSTRO_TRACE_ENABLED"]:
+        celery.labstro_tracer.connect()
+
+    apiv1.setup_api(api, celery, pools = ConnectionPools(celery),
+                    admission = AdmissionControl.from_config(celery),
+                    trace_store = trace_store)
+    return app, celery
+
+
+class LoadGenerator():
+    """
+    Drive the apiv1 endpoints the way devices do, each iteration submits a
+    task with apply_async, polls its result, reports it started and then
+    succeeded or failed, and reads the final result::
+
+        POST /apiv1/task/apply_async/<task_name>
+        GET  /apiv1/task/result/<task_id>
+        PUT  /apiv1/task/started/<task_id>
+        POST /apiv1/task/success/<task_id>  or  /apiv1/task/failed/<task_id>
+        GET  /apiv1/task/result/<task_id>
+
+    Requests go through the Flask test client, latencies are recorded per
+    endpoint and per stage, the stages being the broker publish, result
+    backend writes and result backend reads made by the API.
+
+    """
+
+    def __init__(self, app, celery = None, task_name = "labstro.plugins.simulation.spin",
+                 failure_rate = 0.0, read_back = True, seed = None):
+        """
+        Args:
+            app (flask.Flask):  application serving apiv1.
+
+        Kwargs:
+            celery (celery.Celery):  the application used by the API, its
+                broker and backend calls are timed as stages.
+
+            task_name (str):  task submitted with apply_async.
+
+            failure_rate (float):  fraction of tasks reported as failed.
+
+            read_back (bool):  read the stored result back on callbacks.
+
+            seed (int):  seed of the failure choice.
+
+        """
+        self.app = app
+        self.celery = celery
+        self.task_name = task_name
+        self.failure_rate = failure_rate
+        self.read_back = read_back
+        self.random = random.Random(seed)
+        self.endpoints = LatencyRecorder()
+        self.stages = LatencyRecorder()
+
+    def _instrument(self, obj, patches):
+        """
+        Time methods of obj as stages, the original methods are restored by
+        the returned callable.
+        """
+        for attr, stage in patches:
+            setattr(obj, attr, self.stages.timed(stage, getattr(obj, attr)))
+
+        def restore():
+            for attr, stage in patches:
+                delattr(obj, attr)
+        return restore
+
+    def _request(self, client, endpoint, method, url, body = None):
+        start = time.perf_counter()
+        r = getattr(client, method)(url, json = body)
+        self.endpoints.add(endpoint, time.perf_counter() - start,
+                           error = r.status_code >= 400)
+        return r
+
+    def iteration(self, client):
+        """
+        Run one task through its life cycle.
+        """
+        body = {"args": [{"callback": {"urls": ["http://localhost/callback"]}}],
+                "kwargs": {"schema": "schema/default.schema.json",
+                           "protocol": str(uuid.uuid4())}}
+        r = self._request(client, "apply_async", "post",
+                          "/apiv1/task/apply_async/" + self.task_name, body)
+        task_id = (r.get_json(silent = True) or {}).get("task-id", None)
+        if task_id is None:
+            return
+
+        query = "" if self.read_back else "?read_back=false"
+        self._request(client, "result", "get", "/apiv1/task/result/" + task_id)
+        self._request(client, "started", "put", "/apiv1/task/started/" + task_id + query)
+        if self.random.random() < self.failure_rate:
+            self._request(client, "failed", "post", "/apiv1/task/failed/" + task_id + query,
+                          {"error": "simulated failure"})
+        else:
+            self._request(client, "success", "post", "/apiv1/task/success/" + task_id + query,
+                          {"od600": 0.42})
+        self._request(client, "result", "get", "/apiv1/task/result/" + task_id)
+
+    def _worker(self, iterations, instrument = False):
+        client = self.app.test_client()
+        restore = lambda: None
+        if instrument and self.celery is not None:
+            ## celery keeps a result backend per thread
+            restore = self._instrument(self.celery.backend,
+                                       [("store_result", "backend write"),
+                                        ("get_task_meta", "backend read")])
+        try:
+            for _ in range(iterations):
+                self.iteration(client)
+        finally:
+            restore()
+
+    def run(self, iterations = 100, concurrency = 4, warmup = 5):
+        """
+        Run the load test.
+
+        Kwargs:
+            iterations (int):  task life cycles per concurrent client.
+
+            concurrency (int):  concurrent clients.
+
+            warmup (int):  life cycles run first and left out of the report.
+
+        Returns:
+            (dict):  {"iterations", "concurrency", "duration", "requests",
+                      "throughput", "endpoints": {...}, "stages": {...}}
+
+        """
+        self._worker(warmup)
+        self.endpoints = LatencyRecorder()
+        self.stages = LatencyRecorder()
+
+        restore = lambda: None
+        if self.celery is not None:
+            restore = self._instrument(self.celery, [("send_task", "publish")])
+        try:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers = concurrency) as executor:
+                for f in [executor.submit(self._worker, iterations, True) for _ in range(concurrency)]:
+                    f.result()
+            duration = time.perf_counter() - start
+        finally:
+            restore()
+
+        endpoints = self.endpoints.summary(duration)
+        requests = sum(e["count"] for e in endpoints.values())
+        report = {"iterations": iterations,
+                  "concurrency": concurrency,
+                  "duration": round(duration, 3),
+                  "requests": requests,
+                  "throughput": round(requests / duration, 1) if duration else None,
+                  "endpoints": endpoints,
+                  "stages": self.stages.summary(duration)}
+        logger.info("load test: " + str(requests) + " requests in " + str(report["duration"]) + "s")
+        return report
+
+
+def format_report(report):
+    """
+    Format a report as a table.
+    """
+    lines = [str(report["requests"]) + " requests, " + str(report["concurrency"]) +
+             " clients, " + str(report["duration"]) + "s, " +
+             str(report["throughput"]) + " req/s", ""]
+    row = "{:<16}{:>8}{:>8}{:>10}{:>10}{:>10}"
+    for title in ("endpoints", "stages"):
+        lines.append(row.format(title, "count", "errors", "req/s", "p50 ms", "p99 ms"))
+        for name, s in report[title].items():
+            lines.append(row.format(name, s["count"], s["errors"], str(s["throughput"]),
+                                    str(s["p50"]), str(s["p99"])))
+        lines.append("")
+    return "\n".join(lines)
+
+
+@click.command()
+@click.option("--iterations", default = 100, help = "task life cycles per client")
+@click.option("--concurrency", default = 4, help = "concurrent clients")
+@click.option("--failure-rate", default = 0.0, help = "fraction of tasks reported as failed")
+@click.option("--no-read-back", is_flag = True, help = "skip reading results back on callbacks")
+@click.option("--output", "output_format", type = click.Choice(["table", "json"]), default = "table")
+def main(iterations, concurrency, failure_rate, no_read_back, output_format):
+    """Load test apiv1 against in-memory stand-ins for RabbitMQ and Redis."""
+    app, celery = standin_app()
+    try:
+        report = LoadGenerator(app, celery, failure_rate = failure_rate,
+                               read_back = not no_read_back).run(iterations = iterations,
+                                                                 concurrency = concurrency)
+    finally:
+        celery.labstro_tracer.disconnect()
+    click.echo(json.dumps(report, indent = 2) if output_format == "json" else format_report(report))
+    return 0
+
+
+if __name__ == "__main__":
+    main()  # pragma: no cover
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+
+"""Run celery canvas workflows in-process, without a broker or result backend."""
+
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+import logging
+import multiprocessing
+import threading
+
+from celery import states
+from celery.utils import uuid
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def _apply(task, args, kwargs, task_id, options, started = None):
+    """
+    Execute a task eagerly.  Module level so it can be sent to a process pool.
+
+    Kwargs:
+        started (callable):  called with the task id when execution starts.
+
+    Returns:
+        (tuple):  state, result, traceback
+
+    """
+    if started is not None:
+        started(task_id)
+    r = task.apply(args, kwargs, task_id = task_id, throw = False, **options)
+    result = r.result
+    if r.state in states.EXCEPTION_STATES:
+        result = repr(result)
+    return r.state, result, r.traceback
+
+
+class LocalResult():
+    """
+    Result of a task or workflow executed by a LocalEngine, mirrors the parts
+    of celery.result.AsyncResult used by labstro.
+    """
+
+    def __init__(self, engine, task_id):
+        self.engine = engine
+        self.id = task_id
+
+    def __repr__(self):
+        return "<LocalResult: " + self.id + " " + self.state + ">"
+
+    @property
+    def state(self):
+        return self.engine.states.get(self.id, (states.PENDING, None, None))[0]
+
+    status = state
+
+    @property
+    def result(self):
+        return self.engine.states.get(self.id, (states.PENDING, None, None))[1]
+
+    @property
+    def traceback(self):
+        return self.engine.states.get(self.id, (states.PENDING, None, None))[2]
+
+    def ready(self):
+        return self.state in states.READY_STATES
+
+    def successful(self):
+        return self.state == states.SUCCESS
+
+    def failed(self):
+        return self.state in states.EXCEPTION_STATES
+
+    def get(self, timeout = None):
+        """
+        Wait for the workflow and return its result.  Unlike celery, a failed
+        workflow returns the repr of the exception instead of raising.
+        """
+        future = self.engine._futures.get(self.id, None)
+        if future is not None:
+            future.result(timeout = timeout)
+        return self.result
+
+    def forget(self):
+        self.engine.forget(self.id)
+
+
+class LocalEngine():
+    """
+    Execute celery signatures, chains, groups and chords in-process, e.g. the
+    workflows built by labstro.labstro.AutoprotocolToCelery.to_celery::
+
+        engine = LocalEngine(max_workers = 8)
+        r = engine.apply_async(AutoprotocolToCelery().to_celery(pd, plugins))
+        r.get()
+
+    Workflows are orchestrated by a thread pool while tasks are executed by a
+    separate thread or process pool, so group members run concurrently and
+    orchestration never waits on its own pool.  Task states follow celery
+    semantics, PENDING -> STARTED -> SUCCESS or FAILURE, and a failed task
+    stops the remainder of its chain.
+
+    At most max_results states are kept, the oldest finished ones are
+    dropped first, and results can be dropped earlier with forget.
+
+    """
+
+    def __init__(self, max_workers = None, mode = "thread", max_results = 10000):
+        """
+        Kwargs:
+            max_workers (int):  size of the task pool.
+
+            mode (str):  "thread" or "process", process pools require tasks
+                and their results to be picklable.
+
+            max_results (int):  number of task and workflow states kept.
+
+        """
+        if mode not in ("thread", "process"):
+            raise ValueError("unknown mode: " + str(mode))
+
+        self.mode = mode
+        self.max_results = max_results
+        self.states = OrderedDict()
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._workflows = ThreadPoolExecutor(max_workers = max_workers)
+        if mode == "process":
+            ## task processes report their start through a managed queue
+            self._manager = multiprocessing.Manager()
+            self._started = self._manager.Queue()
+            threading.Thread(target = self._listen_started, daemon = True).start()
+            self._tasks = ProcessPoolExecutor(max_workers = max_workers)
+        else:
+            self._started = None
+            self._tasks = ThreadPoolExecutor(max_workers = max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def shutdown(self, wait = True):
+        self._workflows.shutdown(wait = wait)
+        self._tasks.shutdown(wait = wait)
+        if self._started is not None:
+            self._started.put(None)
+            self._manager.shutdown()
+            self._started = None
+
+    def AsyncResult(self, task_id):
+        return LocalResult(self, task_id)
+
+    def forget(self, task_id):
+        """
+        Drop the state of a task or workflow.
+        """
+        with self._lock:
+            self.states.pop(task_id, None)
+
+    def _set_state(self, task_id, state, result = None, traceback = None):
+        with self._lock:
+            self.states[task_id] = (state, result, traceback)
+            self.states.move_to_end(task_id)
+            if len(self.states) > self.max_results:
+                self._evict()
+
+    def _evict(self):
+        """
+        Drop the oldest finished states, down to 90% of max_results so
+        eviction is not repeated on every update.
+        """
+        target = int(self.max_results * 0.9)
+        for task_id in [k for k, v in self.states.items() if v[0] in states.READY_STATES]:
+            if len(self.states) <= target:
+                break
+            del self.states[task_id]
+
+    def _mark_started(self, task_id):
+        with self._lock:
+            ## process pools may report the start after the task finished
+            if task_id in self.states and self.states[task_id][0] not in states.READY_STATES:
+                self.states[task_id] = (states.STARTED, None, None)
+
+    def _listen_started(self):
+        queue = self._started
+        while True:
+            try:
+                task_id = queue.get()
+            except (EOFError, OSError):
+                return
+            if task_id is None:
+                return
+            self._mark_started(task_id)
+
+    def apply_async(self, sig):
+        """
+        Schedule a workflow.
+
+        Args:
+            sig (celery.canvas.Signature):  task signature, chain, group or chord.
+
+        Returns:
+            (LocalResult):  result of the whole workflow.
+
+        """
+        workflow_id = uuid()
+        self._set_state(workflow_id, states.PENDING)
+        future = self._workflows.submit(self._run_workflow, workflow_id, sig)
+        self._futures[workflow_id] = future
+        ## the final state is set before the future completes
+        future.add_done_callback(lambda f: self._futures.pop(workflow_id, None))
+        return LocalResult(self, workflow_id)
+
+    def apply(self, sig):
+        """
+        Execute a workflow and wait for it.
+        """
+        r = self.apply_async(sig)
+        r.get()
+        return r
+
+    def _run_workflow(self, workflow_id, sig):
+        self._set_state(workflow_id, states.STARTED)
+        try:
+            state, result, traceback = self._run(sig, ())
+        except Exception as e:
+            logger.warning("local workflow " + workflow_id + " failed: " + str(e))
+            state, result, traceback = states.FAILURE, repr(e), None
+        self._set_state(workflow_id, state, result, traceback)
+
+    def _run(self, sig, parent_args):
+        if sig.get("subtask_type", None):
+            return self._run_canvas(sig, parent_args)
+        return self._submit(sig, parent_args)()
+
+    def _start(self, sig, parent_args):
+        """
+        Start a signature, returns a callable waiting for its
+        (state, result, traceback).
+        """
+        subtask_type = sig.get("subtask_type", None)
+        if subtask_type is None:
+            return self._submit(sig, parent_args)
+
+        ## nested workflows get their own thread so they never wait on the
+        ## bounded workflow pool they may be running in
+        future = Future()
+
+        def target():
+            try:
+                future.set_result(self._run_canvas(sig, parent_args))
+            except Exception as e:
+                future.set_exception(e)
+
+        threading.Thread(target = target, daemon = True).start()
+        return future.result
+
+    def _run_canvas(self, sig, parent_args):
+        subtask_type = sig.get("subtask_type", None)
+        if subtask_type == "chain":
+            return self._run_chain(sig.tasks, parent_args)
+        if subtask_type == "group":
+            return self._run_group(sig.tasks, parent_args)
+        if subtask_type == "chord":
+            state, result, traceback = self._run_group(sig.tasks, parent_args)
+            if state != states.SUCCESS:
+                return state, result, traceback
+            return self._run(sig.body, (result,))
+        raise ValueError("unsupported canvas: " + str(subtask_type))
+
+    def _run_chain(self, tasks, parent_args):
+        state, result, traceback = states.SUCCESS, None, None
+        for s in tasks:
+            state, result, traceback = self._run(s, parent_args)
+            if state != states.SUCCESS:
+                break
+            parent_args = (result,)
+        return state, result, traceback
+
+    def _run_group(self, tasks, parent_args):
+        waits = [self._start(s, parent_args) for s in tasks]
+        outcomes = [w() for w in waits]
+        for state, result, traceback in outcomes:
+            if state != states.SUCCESS:
+                return state, result, traceback
+        return states.SUCCESS, [o[1] for o in outcomes], None
+
+    def _submit(self, sig, parent_args):
+        """
+        Submit a single task to the task pool.
+        """
+        options = dict(sig.options)
+        task_id = options.pop("task_id", None) or uuid()
+        args = tuple(sig.args)
+        if not sig.immutable:
+            args = tuple(parent_args) + args
+
+        ## the remaining options are routing hints for a broker
+        apply_options = {k: v for k, v in options.items()
+                         if k in ("retries", "link", "link_error", "headers")}
+
+        self._set_state(task_id, states.PENDING)
+        started = self._mark_started if self._started is None else self._started.put
+        future = self._tasks.submit(_apply, sig.type, args, dict(sig.kwargs),
+                                    task_id, apply_options, started)
+
+        def wait():
+            try:
+                state, result, traceback = future.result()
+            except Exception as e:
+                logger.warning("local task " + sig.task + " failed: " + str(e))
+                state, result, traceback = states.FAILURE, repr(e), None
+            self._set_state(task_id, state, result, traceback)
+            return state, result, traceback
+
+        return wait
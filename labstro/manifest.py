@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+
+"""Plugin discovery and a persisted manifest of operations, tasks and queues."""
+
+import ast
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+import importlib
+import importlib.util
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+## decorators registering a function as a celery task
+TASK_DECORATORS = ("task", "shared_task")
+
+
+def entry_point_plugins(group = "labstro.plugins"):
+    """
+    Return the plugin modules advertised by installed packages, e.g. in
+    setup.py::
+
+        entry_points={
+            'labstro.plugins': [
+                'simulation = labstro.plugins.simulation',
+            ],
+        }
+
+    Kwargs:
+        group (str):  entry point group.
+
+    Returns:
+        (list):  module paths.
+
+    """
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return []
+
+    eps = entry_points()
+    if hasattr(eps, "select"):
+        eps = eps.select(group = group)
+    else:
+        eps = eps.get(group, [])
+    return sorted(set(ep.value.split(":")[0] for ep in eps))
+
+
+def _decorator_task_name(decorator):
+    """
+    Return (is_task, explicit_name) for a function decorator node.
+    """
+    name = None
+    if isinstance(decorator, ast.Call):
+        for k in decorator.keywords:
+            if k.arg == "name" and isinstance(k.value, ast.Constant):
+                name = k.value.value
+        decorator = decorator.func
+
+    if isinstance(decorator, ast.Name):
+        return decorator.id in TASK_DECORATORS, name
+    if isinstance(decorator, ast.Attribute):
+        return decorator.attr in TASK_DECORATORS, name
+    return False, None
+
+
+def _is_task_class(node):
+    """
+    Return True for a class node deriving from a task class, e.g.
+    class Spin(PlugInTask).
+    """
+    for base in node.bases:
+        name = base.id if isinstance(base, ast.Name) else getattr(base, "attr", "")
+        if name.endswith("Task"):
+            return True
+    return False
+
+
+def scan_module(module):
+    """
+    List the tasks of a plugin module by parsing its source, the module is
+    only imported when the source is unavailable or defines class based
+    tasks, whose names are only known once registered.  Plugins driving a single
+    instrument can declare it with a module level constant, e.g.
+    INSTRUMENT = "plate-washer-1".
+
+    Args:
+        module (str):  module path e.g. "labstro.plugins.simulation".
+
+    Returns:
+        (dict):  {"mtime": float, "instrument": str,
+                  "operations": {operation: task_name}}
+
+    """
+    spec = importlib.util.find_spec(module)
+    origin = getattr(spec, "origin", None)
+    if not origin or not origin.endswith(".py"):
+        return _import_module_tasks(module)
+
+    with open(origin, "r") as f:
+        tree = ast.parse(f.read(), filename = origin)
+
+    operations = {}
+    instrument = None
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef) and _is_task_class(node):
+            return _import_module_tasks(module, mtime = os.path.getmtime(origin))
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant):
+            if any(isinstance(t, ast.Name) and t.id == "INSTRUMENT" for t in node.targets):
+                instrument = node.value.value
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        for d in node.decorator_list:
+            is_task, name = _decorator_task_name(d)
+            if is_task:
+                operations[node.name] = name or ".".join([module, node.name])
+
+    return {"mtime": os.path.getmtime(origin), "instrument": instrument,
+            "operations": operations}
+
+
+def _import_module_tasks(module, mtime = None):
+    """
+    List the tasks of a plugin module by importing it.  Task instances are
+    listed under their attribute name, task classes defined by the module
+    under the last part of their task name.
+    """
+    from celery import Task
+
+    m = importlib.import_module(module)
+    operations = {}
+    for k, v in vars(m).items():
+        if isinstance(v, Task):
+            operations[k] = v.name
+        elif isinstance(v, type) and issubclass(v, Task) and v.__module__ == module \
+                and isinstance(getattr(v, "name", None), str):
+            operations.setdefault(v.name.rsplit(".", 1)[-1], v.name)
+    return {"mtime": mtime, "instrument": getattr(m, "INSTRUMENT", None),
+            "operations": operations}
+
+
+def _module_mtime(module):
+    spec = importlib.util.find_spec(module)
+    origin = getattr(spec, "origin", None)
+    if not origin or not os.path.exists(origin):
+        return None
+    return os.path.getmtime(origin)
+
+
+class PluginManifest():
+    """
+    Persisted map of plugin operations to task names and queues.
+
+    Plugins are the configured modules plus the modules advertised under the
+    labstro.plugins entry point group.  Modules are scanned in parallel,
+    without importing them, and the result is written to a JSON file so
+    startup and routing only read the manifest.  Modules whose source changed
+    since the manifest was written are rescanned.
+
+    """
+
+    def __init__(self, path = None, plugins = None, routes = None,
+                 group = "labstro.plugins"):
+        """
+        Kwargs:
+            path (str):  manifest file, the manifest is kept in memory only
+                when None.
+
+            plugins (list):  module paths to include in addition to the
+                entry points e.g. ["labstro.plugins.simulation"].
+
+            routes (dict):  celery task routes used to resolve queues.
+
+            group (str):  entry point group.
+
+        """
+        self.path = path
+        self.plugins = list(plugins or [])
+        self.routes = routes or {}
+        self.group = group
+        self.modules = {}
+        ## modules scanned or removed by the last refresh
+        self.changed = []
+        ## content of the manifest file when last read or written
+        self._saved = None
+
+    def discover(self):
+        """
+        Return the module paths of all plugins.
+        """
+        found = list(self.plugins)
+        for p in entry_point_plugins(self.group):
+            if p not in found:
+                found.append(p)
+        return found
+
+    def load(self):
+        """
+        Read the manifest file if it exists.
+        """
+        if self.path and os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self._saved = json.load(f)
+            self.modules = self._saved.get("modules", {})
+        return self
+
+    def save(self):
+        """
+        Write the manifest file when its content changed, through a
+        temporary file replacing it at once so processes starting together
+        never read a partial manifest.  A manifest that cannot be written is
+        kept in memory.
+        """
+        content = json.loads(json.dumps({"modules": self.modules, "tasks": self.tasks()}))
+        if not self.path or content == self._saved:
+            return self
+
+        tmp = self.path + "." + str(os.getpid()) + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(content, f, indent = 2, sort_keys = True)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning("unable to write the plugin manifest " + self.path + ": " + str(e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return self
+        self._saved = content
+        return self
+
+    def _stale(self, module):
+        entry = self.modules.get(module, None)
+        if entry is None:
+            return True
+        return entry["mtime"] is None or entry["mtime"] != _module_mtime(module)
+
+    def refresh(self, max_workers = None):
+        """
+        Load the manifest and rescan new or modified plugins in parallel,
+        the manifest is saved when anything changed.
+
+        Kwargs:
+            max_workers (int):  size of the scanning thread pool.
+
+        Returns:
+            (PluginManifest)
+
+        """
+        self.load()
+        modules = self.discover()
+        stale = [m for m in modules if self._stale(m)]
+        removed = [m for m in self.modules if m not in modules]
+
+        if stale:
+            with ThreadPoolExecutor(max_workers = max_workers) as pool:
+                for m, entry in zip(stale, pool.map(scan_module, stale)):
+                    self.modules[m] = entry
+                    logger.info("scanned plugin " + m + ": " + ", ".join(entry["operations"]))
+        for m in removed:
+            del self.modules[m]
+
+        self.changed = stale + removed
+        if stale or removed:
+            self.save()
+        return self
+
+    def queue(self, task_name):
+        """
+        Resolve the queue of a task from glob style task routes.
+        """
+        for pattern, route in self.routes.items():
+            if fnmatch(task_name, pattern):
+                return route.get("queue", None)
+        return None
+
+    def tasks(self):
+        """
+        Return every task of the manifest.
+
+        Returns:
+            (dict):  {task_name: {"plugin": str, "operation": str, "queue": str}}
+
+        """
+        return {t: {"plugin": m, "operation": o, "queue": self.queue(t)}
+                for m, entry in self.modules.items()
+                for o, t in entry["operations"].items()}
+
+    def route(self, operations, plugins = None):
+        """
+        Map operations to task names, equivalent to
+        labstro.labstro.AutoprotocolToCelery.route_plugins without importing
+        the plugins.
+
+        Args:
+            operations (list):  a list of operations e.g., ["seal", "spin"]
+
+        Kwargs:
+            plugins (list):  restrict routing to these plugins, all plugins of
+                the manifest by default.
+
+        Returns:
+            (dict):  a map of each operation to a list of task names.
+
+        """
+        plugins = plugins if plugins is not None else list(self.modules)
+        rmap = {}
+        for o in operations:
+            for p in plugins:
+                t = self.modules.get(p, {}).get("operations", {}).get(o, None)
+                if t:
+                    rmap.setdefault(o, []).append(t)
+        return rmap
@@ -1,6 +1,7 @@
 ## opensean
 from celery import shared_task
 from celery import Task
+from labstro.containers import ContainerRegistry
 
 class PlugInTask(Task):
     """
@@ -67,6 +68,13 @@ class PlugInTask(Task):
         """
         return self._client
 
+    def containers(self, refs):
+        """
+        Return a labstro.containers.ContainerRegistry indexing the refs passed
+        to the task, using the catalog set by LABSTRO_CONTAINER_CATALOG and
+        the inventory set by LABSTRO_CONTAINER_INVENTORY.
 
-   
-
+        """
+        return ContainerRegistry.from_refs(refs,
+                    catalog = self.app.conf.get("LABSTRO_CONTAINER_CATALOG", None),
+                    inventory = self.app.conf.get("LABSTRO_CONTAINER_INVENTORY", None))
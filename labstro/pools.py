@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""Broker and result backend connection pools for the API process."""
+
+from contextlib import contextmanager
+import logging
+import os
+import threading
+import weakref
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+## pools of this process, reset by a single fork hook
+_instances = weakref.WeakSet()
+
+
+def _reset_after_fork():
+    for pools in list(_instances):
+        pools.reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child = _reset_after_fork)
+
+
+class ConnectionPools():
+    """
+    Share AMQP producers and result backend clients across API requests.
+
+    Celery already keeps a producer pool sized by broker_pool_limit and the
+    redis result backend a connection pool sized by redis_max_connections,
+    both per process.  ConnectionPools hands out producers from that pool,
+    keeps statistics and drops inherited connections in child processes so
+    the pools are safe to create before gunicorn forks its workers.
+
+    """
+
+    def __init__(self, celery):
+        """
+        Args:
+            celery (celery.Celery):  instance of a Celery application.
+
+        """
+        self.celery = celery
+        self._lock = threading.Lock()
+        self._acquired = 0
+        self._released = 0
+        self._errors = 0
+        self._forks = 0
+        self.pid = os.getpid()
+        _instances.add(self)
+
+    @contextmanager
+    def producer(self, block = True):
+        """
+        Acquire a producer from the broker pool, to be passed to
+        celery.Celery.send_task e.g.::
+
+            with pools.producer() as producer:
+                celery.send_task("labstro.plugins.simulation.seal",
+                                 producer = producer)
+
+        Kwargs:
+            block (bool):  wait for a producer when the pool is exhausted.
+
+        """
+        with self._lock:
+            self._acquired += 1
+        try:
+            with self.celery.producer_pool.acquire(block = block) as producer:
+                yield producer
+        except Exception:
+            with self._lock:
+                self._errors += 1
+            raise
+        finally:
+            with self._lock:
+                self._released += 1
+
+    def reset(self):
+        """
+        Discard connections inherited from a parent process, they are
+        re-established lazily by the child.
+        """
+        ## celery's own after fork cleanup of the broker and producer pools,
+        ## redis-py replaces its connection pool itself on a pid change
+        self.celery._after_fork()
+        self._lock = threading.Lock()
+        self._acquired = 0
+        self._released = 0
+        self._forks += 1
+        self.pid = os.getpid()
+
+    def backend_stats(self):
+        """
+        Return the limit of the result backend connection pool, empty if the
+        backend is not pooled.  redis-py has no public connection counters.
+        """
+        client = getattr(self.celery.backend, "client", None)
+        pool = getattr(client, "connection_pool", None)
+        if pool is None:
+            return {}
+
+        return {"limit": pool.max_connections}
+
+    def broker_stats(self):
+        """
+        Return statistics of the broker producer pool, counted by this
+        process since its last fork.
+        """
+        return {"limit": self.celery.producer_pool.limit,
+                "in_use": self._acquired - self._released,
+                "acquired": self._acquired,
+                "released": self._released,
+                "errors": self._errors}
+
+    def stats(self):
+        """
+        Return broker and backend pool statistics for this process.
+        """
+        return {"pid": self.pid,
+                "forks": self._forks,
+                "broker": self.broker_stats(),
+                "backend": self.backend_stats()}
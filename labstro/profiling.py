@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+"""Opt-in cProfile profiling of task execution."""
+
+import cProfile
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+from celery.worker.control import control_command
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_UNSAFE = re.compile(r"[^A-Za-z0-9_.-]")
+
+## configuration written by configure, read by every profiler sharing the
+## directory
+CONFIG_FILE = "profiling.json"
+
+
+class TaskProfiler():
+    """
+    Profile task executions with cProfile and write the stats to an artifact
+    directory, one file per profiled execution, e.g.
+    profiles/labstro.plugins.simulation.spin.1573179563123.<task_id>.prof
+
+    Profiles are written by the workers and listed and served by the API
+    from its own directory, so the directory must be a volume shared by the
+    workers and the API, e.g. an absolute LABSTRO_PROFILE_DIR on a shared
+    mount.
+
+    A task is profiled when its name is listed in tasks, or otherwise with a
+    probability of sample_rate.  Both can be changed at runtime with
+    configure, which writes them to the directory.  Tasks of prefork workers
+    run in pool processes that remote control commands do not reach, so
+    every profiler rereads the configuration from the directory at most
+    once per reload_interval seconds, a configuration left in the directory
+    takes precedence over the settings.  Profiles can be read with pstats or
+    snakeviz.
+
+    """
+
+    def __init__(self, directory, tasks = None, sample_rate = 0.0, keep = 100,
+                 random = random.random, reload_interval = 1.0, clock = time.monotonic):
+        """
+        Args:
+            directory (str):  artifact directory.
+
+        Kwargs:
+            tasks (list):  task names to always profile.
+
+            sample_rate (float):  probability of profiling any other task.
+
+            keep (int):  number of profiles kept, older ones are deleted.
+
+            random (callable):  returns a float in [0, 1).
+
+            reload_interval (float):  seconds between checks of the
+                configuration written to the directory.
+
+            clock (callable):  returns the current time in seconds.
+
+        """
+        self.directory = directory
+        self.tasks = set(tasks or [])
+        self.sample_rate = float(sample_rate or 0.0)
+        self.keep = keep
+        self.random = random
+        self.reload_interval = reload_interval
+        self.clock = clock
+        self._local = threading.local()
+        self._mtime = None
+        self._checked = None
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Build a profiler from the LABSTRO_PROFILE_* settings.
+        """
+        return cls(config.get("LABSTRO_PROFILE_DIR", "profiles"),
+                   tasks = config.get("LABSTRO_PROFILE_TASKS", None),
+                   sample_rate = config.get("LABSTRO_PROFILE_SAMPLE_RATE", 0.0),
+                   keep = config.get("LABSTRO_PROFILE_KEEP", 100))
+
+    @property
+    def enabled(self):
+        self.reload()
+        return bool(self.tasks) or self.sample_rate > 0
+
+    def reload(self):
+        """
+        Read the configuration written by configure in any process sharing
+        the directory, at most once per reload_interval seconds.
+        """
+        now = self.clock()
+        if self._checked is not None and now - self._checked < self.reload_interval:
+            return
+        self._checked = now
+
+        path = os.path.join(self.directory, CONFIG_FILE)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            if mtime == self._mtime:
+                return
+            with open(path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("unable to read profiling config " + path + ": " + str(e))
+            return
+        self._mtime = mtime
+        self.tasks = set(data.get("tasks", []))
+        self.sample_rate = float(data.get("sample_rate", 0.0))
+
+    def _save(self):
+        path = os.path.join(self.directory, CONFIG_FILE)
+        tmp = path + "." + str(os.getpid()) + ".tmp"
+        try:
+            os.makedirs(self.directory, exist_ok = True)
+            with open(tmp, "w") as f:
+                json.dump(self.config(), f)
+            os.replace(tmp, path)
+            self._mtime = os.stat(path).st_mtime_ns
+        except OSError as e:
+            logger.warning("unable to write profiling config " + path + ": " + str(e))
+
+    def configure(self, tasks = None, sample_rate = None):
+        """
+        Change which tasks are profiled.
+
+        Kwargs:
+            tasks (list):  task names to always profile, replaces the current
+                list when not None.
+
+            sample_rate (float):  probability of profiling any other task.
+
+        Returns:
+            (dict):  the resulting configuration.
+
+        Raises:
+            ValueError:  tasks is not a list of task names or sample_rate is
+                not a number between 0 and 1, nothing is changed.
+
+        """
+        if tasks is not None:
+            if not isinstance(tasks, (list, tuple)) or not all(isinstance(t, str) for t in tasks):
+                raise ValueError("tasks must be a list of task names")
+        if sample_rate is not None:
+            if isinstance(sample_rate, bool) or not isinstance(sample_rate, (int, float)) \
+                    or not 0.0 <= sample_rate <= 1.0:
+                raise ValueError("sample_rate must be a number between 0 and 1")
+
+        self.reload()
+        if tasks is not None:
+            self.tasks = set(tasks)
+        if sample_rate is not None:
+            self.sample_rate = float(sample_rate)
+        self._save()
+        logger.info("profiling " + str(sorted(self.tasks)) + " sample rate " + str(self.sample_rate))
+        return self.config()
+
+    def config(self):
+        return {"tasks": sorted(self.tasks), "sample_rate": self.sample_rate}
+
+    def should_profile(self, task_name):
+        """
+        Decide whether an execution of task_name is profiled.  Nested task
+        calls are never profiled separately.
+        """
+        if getattr(self._local, "active", False):
+            return False
+        self.reload()
+        if task_name in self.tasks:
+            return True
+        return self.sample_rate > 0 and self.random() < self.sample_rate
+
+    def run(self, task_name, task_id, fun, *args, **kwargs):
+        """
+        Call fun under cProfile and write its stats, the return value or
+        exception of fun is passed through.
+        """
+        profile = cProfile.Profile()
+        self._local.active = True
+        try:
+            return profile.runcall(fun, *args, **kwargs)
+        finally:
+            self._local.active = False
+            try:
+                self._dump(profile, task_name, task_id)
+            except Exception as e:
+                ## profiling must never fail a task
+                logger.warning("unable to write profile of " + task_name + ": " + str(e))
+
+    def _dump(self, profile, task_name, task_id):
+        os.makedirs(self.directory, exist_ok = True)
+        name = ".".join([_UNSAFE.sub("_", task_name),
+                         str(int(time.time() * 1000)),
+                         _UNSAFE.sub("_", str(task_id)), "prof"])
+        profile.dump_stats(os.path.join(self.directory, name))
+        self._prune()
+
+    def _prune(self):
+        if not self.keep:
+            return
+        for p in self.list()[self.keep:]:
+            os.remove(os.path.join(self.directory, p["name"]))
+
+    def list(self):
+        """
+        Return the stored profiles, most recent first.
+
+        Returns:
+            (list):  [{"name": str, "task": str, "task_id": str,
+                       "created": float, "size": int}, ...]
+
+        """
+        if not os.path.isdir(self.directory):
+            return []
+
+        profiles = []
+        for name in os.listdir(self.directory):
+            parts = name.split(".")
+            if len(parts) < 4 or parts[-1] != "prof" or not parts[-3].isdigit():
+                continue
+            stat = os.stat(os.path.join(self.directory, name))
+            profiles.append({"name": name,
+                             "task": ".".join(parts[:-3]),
+                             "task_id": parts[-2],
+                             "created": int(parts[-3]) / 1000.0,
+                             "size": stat.st_size})
+        return sorted(profiles, key = lambda p: p["created"], reverse = True)
+
+    def path(self, name):
+        """
+        Return the file path of a stored profile, None if it does not exist.
+        """
+        if _UNSAFE.search(name) or name.startswith(".") or not name.endswith(".prof"):
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.isfile(path) else None
+
+
+@control_command(
+    args = [("tasks", list), ("sample_rate", float)],
+    signature = "[tasks] [sample_rate]",
+)
+def labstro_profiling(state, tasks = None, sample_rate = None):
+    """Change which tasks are profiled by this worker and its pool processes."""
+    profiler = getattr(state.app, "labstro_profiler", None)
+    if profiler is None:
+        return {"error": "profiling not available"}
+    try:
+        return {"ok": profiler.configure(tasks = tasks, sample_rate = sample_rate)}
+    except ValueError as e:
+        return {"error": str(e)}
@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+
+"""Retention of task results: TTLs, per-protocol compaction and archival."""
+
+from datetime import datetime, timezone
+from fnmatch import fnmatch
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+
+from celery import shared_task, current_app
+from celery.signals import task_postrun
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class RetentionPolicy():
+    """
+    Seconds the result of a task is kept in the result backend, looked up
+    by task name pattern first, e.g. "labstro.plugins.simulation.*", then
+    by queue, then the default.
+    """
+
+    def __init__(self, default = None, tasks = None, queues = None):
+        """
+        Kwargs:
+            default (int):  TTL of other tasks, None keeps the backend expiry.
+
+            tasks (dict):  TTL per task name pattern.
+
+            queues (dict):  TTL per queue name.
+
+        """
+        self.default = default
+        self.tasks = tasks or {}
+        self.queues = queues or {}
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(default = config.get("LABSTRO_RESULT_EXPIRES", None),
+                   tasks = config.get("LABSTRO_RETENTION_TASK_TTLS", None),
+                   queues = config.get("LABSTRO_RETENTION_QUEUE_TTLS", None))
+
+    def ttl(self, task_name = None, queue = None):
+        for pattern, ttl in self.tasks.items():
+            if task_name is not None and fnmatch(task_name, pattern):
+                return ttl
+        if queue in self.queues:
+            return self.queues[queue]
+        return self.default
+
+    def as_dict(self):
+        return {"default": self.default, "tasks": self.tasks, "queues": self.queues}
+
+
+def _json(record):
+    return json.dumps(record, default = str)
+
+
+class LocalSummaryStore():
+    """
+    Keep protocol summaries in memory, for tests.
+    """
+
+    def __init__(self):
+        self._summaries = {}
+        self._archived = {}
+        self._lock = threading.Lock()
+
+    def put(self, protocol_id, summary):
+        with self._lock:
+            self._summaries[protocol_id] = json.loads(_json(summary))
+
+    def get(self, protocol_id):
+        with self._lock:
+            return self._summaries.get(protocol_id, None)
+
+    def delete(self, protocol_id):
+        with self._lock:
+            self._summaries.pop(protocol_id, None)
+
+    def protocols(self):
+        with self._lock:
+            return sorted(self._summaries)
+
+    def set_archived(self, files):
+        with self._lock:
+            self._archived.update(files)
+
+    def archived(self, protocol_id):
+        with self._lock:
+            return self._archived.get(protocol_id, None)
+
+
+class RedisSummaryStore():
+    """
+    Keep protocol summaries in redis, one key per protocol, and the archive
+    file of each archived protocol in a hash.
+    """
+
+    def __init__(self, client, prefix = "labstro:summary:", index = "labstro:archived"):
+        self.client = client
+        self.prefix = prefix
+        self.index = index
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        import redis
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def put(self, protocol_id, summary):
+        self.client.set(self.prefix + protocol_id, _json(summary))
+
+    def get(self, protocol_id):
+        value = self.client.get(self.prefix + protocol_id)
+        return json.loads(value) if value is not None else None
+
+    def delete(self, protocol_id):
+        self.client.delete(self.prefix + protocol_id)
+
+    def protocols(self):
+        keys = [k.decode() if isinstance(k, bytes) else k
+                for k in self.client.scan_iter(match = self.prefix + "*")]
+        return sorted(k[len(self.prefix):] for k in keys)
+
+    def set_archived(self, files):
+        if files:
+            self.client.hset(self.index, mapping = files)
+
+    def archived(self, protocol_id):
+        value = self.client.hget(self.index, protocol_id)
+        return value.decode() if isinstance(value, bytes) else value
+
+
+class ResultArchive():
+    """
+    Archive protocol summaries to gzipped JSON lines files, one file per day
+    of compaction e.g. archive/results-2019-11-08.jsonl.gz.  Each archival
+    appends a gzip member so files never need rewriting.  The files are
+    written by the worker running maintain and read by the API, so directory
+    must be an absolute path on a volume both of them mount.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def append(self, summaries):
+        """
+        Append summaries to the file of the day they were compacted.
+
+        Returns:
+            (dict):  {protocol_id: archive file name}
+
+        """
+        files = {}
+        days = {}
+        for s in summaries:
+            day = datetime.fromtimestamp(s["compacted_at"], timezone.utc).strftime("%Y-%m-%d")
+            days.setdefault(day, []).append(s)
+
+        with self._lock:
+            os.makedirs(self.directory, exist_ok = True)
+            for day, records in days.items():
+                name = "results-" + day + ".jsonl.gz"
+                with gzip.open(os.path.join(self.directory, name), "at", encoding = "utf-8") as f:
+                    for r in records:
+                        f.write(_json(r) + "\n")
+                        files[r["protocol_id"]] = name
+        return files
+
+    def files(self):
+        """
+        Return the archive files, most recent first.
+
+        Returns:
+            (list):  [{"name": str, "size": int}, ...]
+
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        names = sorted((n for n in os.listdir(self.directory)
+                        if n.startswith("results-") and n.endswith(".jsonl.gz")), reverse = True)
+        return [{"name": n, "size": os.stat(os.path.join(self.directory, n)).st_size}
+                for n in names]
+
+    def find(self, protocol_id, name):
+        """
+        Return the most recently archived summary of a protocol in the
+        archive file name, None when it is not there.
+        """
+        path = os.path.join(self.directory, name)
+        if not os.path.isfile(path):
+            return None
+        found = None
+        with gzip.open(path, "rt", encoding = "utf-8") as lines:
+            for line in lines:
+                ## skip decoding records of other protocols
+                if protocol_id not in line:
+                    continue
+                record = json.loads(line)
+                if record["protocol_id"] == protocol_id:
+                    found = record
+        return found
+
+
+class ResultRetention():
+    """
+    Bound the size of the result backend.
+
+    Workers apply the TTL of the RetentionPolicy to every result they store.
+    The results of a traced protocol, once idle for compact_after seconds,
+    are compacted into one summary record and the per-instruction results
+    are deleted.  Summaries older than archive_after seconds are moved to a
+    ResultArchive and the archive file of each protocol is recorded in the
+    summary store.  Compaction finds the tasks of a protocol in its trace,
+    so only protocols submitted with a protocol_id are compacted, and drops
+    the trace once every task in it is compacted.  The archive directory is
+    shared by the workers and the API, see ResultArchive.
+
+    """
+
+    def __init__(self, celery, trace_store, summaries, archive, policy = None,
+                 compact_after = 600, archive_after = 7 * 24 * 3600, clock = time.time):
+        """
+        Args:
+            celery (celery.Celery):  instance of a Celery application.
+
+            trace_store (LocalTraceStore or RedisTraceStore):  protocol traces.
+
+            summaries (LocalSummaryStore or RedisSummaryStore):  summary storage.
+
+            archive (ResultArchive):  archive of old summaries.
+
+        Kwargs:
+            policy (RetentionPolicy):  result TTLs.
+
+            compact_after (float):  seconds a protocol is idle before compaction.
+
+            archive_after (float):  seconds a summary is kept before archival.
+
+            clock (callable):  returns the current time in seconds.
+
+        """
+        self.celery = celery
+        self.trace_store = trace_store
+        self.summaries = summaries
+        self.archive = archive
+        self.policy = policy or RetentionPolicy()
+        self.compact_after = compact_after
+        self.archive_after = archive_after
+        self.clock = clock
+
+    @property
+    def backend(self):
+        ## celery keeps a result backend per thread
+        return self.celery.backend
+
+    @classmethod
+    def from_config(cls, celery, trace_store):
+        """
+        Build retention from the LABSTRO_RETENTION_* settings.
+        """
+        conf = celery.conf
+        directory = conf.get("LABSTRO_RETENTION_ARCHIVE_DIR", "/var/lib/labstro/archive")
+        if not os.path.isabs(directory):
+            ## relative to the CWD of each process, the API misses worker files
+            raise ValueError("LABSTRO_RETENTION_ARCHIVE_DIR must be an absolute path: " + directory)
+        return cls(celery, trace_store,
+                   RedisSummaryStore.from_url(conf["LABSTRO_RETENTION_REDIS_URL"]),
+                   ResultArchive(directory),
+                   policy = RetentionPolicy.from_config(conf),
+                   compact_after = conf.get("LABSTRO_RETENTION_COMPACT_AFTER", 600),
+                   archive_after = conf.get("LABSTRO_RETENTION_ARCHIVE_AFTER", 7 * 24 * 3600))
+
+    def connect(self):
+        """
+        Apply result TTLs in the workers of this process.
+        """
+        task_postrun.connect(self.on_postrun, weak = False)
+        return self
+
+    def disconnect(self):
+        task_postrun.disconnect(self.on_postrun)
+
+    def on_postrun(self, task_id = None, task = None, **kwargs):
+        request = getattr(task, "request", None)
+        queue = (getattr(request, "delivery_info", None) or {}).get("routing_key", None)
+        ttl = self.policy.ttl(getattr(task, "name", None), queue)
+        if not ttl or ttl == self.backend.expires:
+            return
+        try:
+            self.backend.expire(self.backend.get_key_for_task(task_id), int(ttl))
+        except Exception as e:
+            ## retention must never fail a task
+            logger.warning("unable to set the TTL of " + str(task_id) + ": " + str(e))
+
+    def summarize(self, protocol_id, events, summary = None):
+        """
+        Merge the results of the finished tasks of a protocol into its summary.
+
+        Args:
+            protocol_id (str):  traced protocol.
+
+            events (list):  trace events of the protocol.
+
+        Kwargs:
+            summary (dict):  previous summary of the protocol.
+
+        Returns:
+            (dict, list):  the summary and the ids of the newly compacted tasks.
+
+        """
+        summary = summary or {"protocol_id": protocol_id, "tasks": []}
+        compacted = {t["task_id"] for t in summary["tasks"]}
+        tasks = {}
+        for e in events:
+            t = tasks.setdefault(e["task_id"], {"task_id": e["task_id"], "task": e["task"],
+                                                "instruction": e.get("instruction", None)})
+            t[e["event"]] = e["ts"]
+            if e["event"] == "finished":
+                t["worker"] = e.get("worker", None)
+
+        new = []
+        for task_id, t in tasks.items():
+            if task_id in compacted or "finished" not in t:
+                continue
+            meta = self.backend.get_task_meta(task_id)
+            summary["tasks"].append({"task_id": task_id,
+                                     "task": t["task"],
+                                     "instruction": t["instruction"],
+                                     "worker": t.get("worker", None),
+                                     "queued": t.get("queued", None),
+                                     "started": t.get("started", None),
+                                     "finished": t["finished"],
+                                     "state": meta.get("status", None),
+                                     "result": meta.get("result", None),
+                                     "traceback": meta.get("traceback", None)})
+            new.append(task_id)
+
+        summary["tasks"].sort(key = lambda t: (t["instruction"] is None, t["instruction"], t["finished"]))
+        states = {}
+        for t in summary["tasks"]:
+            states[t["state"]] = states.get(t["state"], 0) + 1
+        summary.update({"compacted_at": self.clock(),
+                        "states": states,
+                        "started": min([t["started"] or t["finished"] for t in summary["tasks"]] or [None]),
+                        "finished": max([t["finished"] for t in summary["tasks"]] or [None])})
+        return summary, new
+
+    def compact(self, protocol_id = None):
+        """
+        Compact the idle protocols, or a single protocol regardless of idle
+        time.
+
+        Kwargs:
+            protocol_id (str):  protocol to compact now.
+
+        Returns:
+            (dict):  {protocol_id: number of compacted results}
+
+        """
+        protocol_ids = [protocol_id] if protocol_id is not None else self.trace_store.protocols()
+        now = self.clock()
+        done = {}
+        for pid in protocol_ids:
+            events = self.trace_store.events(pid)
+            if not events:
+                continue
+            last = max(e["ts"] for e in events)
+            previous = self.summaries.get(pid)
+            if previous is not None and last <= previous["compacted_at"]:
+                continue
+            if protocol_id is None and now - last < self.compact_after:
+                continue
+
+            summary, new = self.summarize(pid, events, previous)
+            if new:
+                self.summaries.put(pid, summary)
+                for task_id in new:
+                    self.backend.forget(task_id)
+                done[pid] = len(new)
+                logger.info("compacted " + str(len(new)) + " results of protocol " + pid)
+
+            ## the trace of a compacted protocol would be compacted again once
+            ## its summary is archived, with the results already forgotten
+            finished = {e["task_id"] for e in events if e["event"] == "finished"}
+            if all(e["task_id"] in finished for e in events):
+                self.trace_store.trim(pid, len(events))
+        return done
+
+    def archive_old(self):
+        """
+        Move summaries older than archive_after to the archive.
+
+        Returns:
+            (list):  archived protocol ids.
+
+        """
+        now = self.clock()
+        old = []
+        for pid in self.summaries.protocols():
+            summary = self.summaries.get(pid)
+            if summary is not None and now - summary["compacted_at"] >= self.archive_after:
+                old.append(summary)
+
+        if old:
+            self.summaries.set_archived(self.archive.append(old))
+            for s in old:
+                self.summaries.delete(s["protocol_id"])
+                ## unfinished tasks of an archived protocol are not compacted
+                self.trace_store.trim(s["protocol_id"])
+            logger.info("archived " + str(len(old)) + " protocol summaries")
+        return [s["protocol_id"] for s in old]
+
+    def run(self):
+        """
+        Compact idle protocols and archive old summaries.
+        """
+        return {"compacted": self.compact(), "archived": self.archive_old()}
+
+    def lookup(self, protocol_id):
+        """
+        Return the summary of a protocol and where it was found, "summary"
+        or "archive", or (None, None).
+        """
+        summary = self.summaries.get(protocol_id)
+        if summary is not None:
+            return summary, "summary"
+        name = self.summaries.archived(protocol_id)
+        summary = self.archive.find(protocol_id, name) if name is not None else None
+        if summary is not None:
+            return summary, "archive"
+        if name is not None:
+            logger.warning("archive file " + name + " of " + protocol_id + " is not in "
+                           + self.archive.directory + ", is it shared with the workers?")
+        return None, None
+
+    def stats(self):
+        return {"policy": self.policy.as_dict(),
+                "compact_after": self.compact_after,
+                "archive_after": self.archive_after,
+                "summaries": len(self.summaries.protocols()),
+                "archive": self.archive.files()}
+
+
+@shared_task(name = "labstro.retention.maintain")
+def maintain():
+    """Compact idle protocols and archive old summaries, run by celery beat."""
+    retention = getattr(current_app, "labstro_retention", None)
+    if retention is None:
+        return {"error": "retention not available"}
+    return retention.run()
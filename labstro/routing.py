@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+"""Task routes and queues generated from the plugin manifest."""
+
+import logging
+import threading
+import time
+
+from kombu import Queue
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def plugin_queue(plugin, instrument = None, prefix = "labstro-"):
+    """
+    Return the queue of a plugin, one queue per instrument when the plugin
+    declares one, otherwise one queue per plugin.
+
+    Args:
+        plugin (str):  module path e.g. "labstro.plugins.simulation".
+
+    Kwargs:
+        instrument (str):  instrument declared by the plugin.
+
+        prefix (str):  queue name prefix.
+
+    Returns:
+        (str):  e.g. "labstro-simulation"
+
+    """
+    return prefix + (instrument or plugin.rsplit(".", 1)[-1])
+
+
+def generate_routes(manifest, prefix = "labstro-", static = None):
+    """
+    Generate celery task routes for every plugin of a manifest.
+
+    Args:
+        manifest (labstro.manifest.PluginManifest):  discovered plugins.
+
+    Kwargs:
+        prefix (str):  queue name prefix.
+
+        static (dict):  hand written routes, they take precedence over the
+            generated ones.
+
+    Returns:
+        (dict):  e.g. {"labstro.plugins.simulation.*": {"queue": "labstro-simulation"}}
+
+    """
+    routes = dict(static or {})
+    for plugin, entry in sorted(manifest.modules.items()):
+        routes.setdefault(plugin + ".*",
+                          {"queue": plugin_queue(plugin, entry.get("instrument", None), prefix)})
+    return routes
+
+
+def generate_queues(routes, max_priority = None, default_queue = "celery"):
+    """
+    Declare a queue for every route, as priority queues when max_priority
+    is set.  Existing queues declared with other arguments must be deleted
+    first, RabbitMQ rejects the declaration with PRECONDITION_FAILED.
+
+    Args:
+        routes (dict):  celery task routes.
+
+    Kwargs:
+        max_priority (int):  x-max-priority of the queues.
+
+        default_queue (str):  queue of unrouted tasks.
+
+    Returns:
+        (list):  [kombu.Queue, ...]
+
+    """
+    arguments = {"x-max-priority": max_priority} if max_priority else None
+    names = [default_queue]
+    for route in routes.values():
+        q = route.get("queue", None)
+        if q and q not in names:
+            names.append(q)
+    return [Queue(q, routing_key = q, queue_arguments = arguments) for q in names]
+
+
+def worker_queues(manifest, plugins, prefix = "labstro-"):
+    """
+    Return the queues a worker pinned to plugins should consume.
+
+    Args:
+        manifest (labstro.manifest.PluginManifest):  discovered plugins.
+
+        plugins (list):  module paths the worker serves.
+
+    Kwargs:
+        prefix (str):  queue name prefix.
+
+    Returns:
+        (list):  queue names.
+
+    """
+    queues = []
+    for p in plugins:
+        entry = manifest.modules.get(p, None)
+        if entry is None:
+            raise ValueError("plugin not in manifest: " + p)
+        q = manifest.queue(p + ".*") or plugin_queue(p, entry.get("instrument", None), prefix)
+        if q not in queues:
+            queues.append(q)
+    return queues
+
+
+def pin_worker(app, queues):
+    """
+    Restrict a worker to queues so tasks of a device always land on the
+    worker holding its client, call from the celeryd_after_setup signal.
+
+    Args:
+        app (celery.Celery):  the worker's Celery application.
+
+        queues (list):  queue names.
+
+    """
+    app.amqp.queues.select(queues)
+    logger.info("worker pinned to queues: " + ", ".join(queues))
+
+
+class RouteRefresher():
+    """
+    Keep the task routes and queues of a celery application in step with
+    the plugin manifest, plugins installed or added to the configuration
+    after startup are routed to their own queue once the manifest is
+    refreshed.  Workers only consume the queues of a new plugin once they
+    are restarted with it.
+
+    """
+
+    def __init__(self, celery, manifest, prefix = "labstro-", static = None,
+                 max_priority = None, interval = 60.0, clock = time.monotonic):
+        """
+        Args:
+            celery (celery.Celery):  instance of a Celery application.
+
+            manifest (labstro.manifest.PluginManifest):  discovered plugins.
+
+        Kwargs:
+            prefix (str):  queue name prefix.
+
+            static (dict):  hand written routes.
+
+            max_priority (int):  x-max-priority of the queues.
+
+            interval (float):  minimum seconds between two refreshes.
+
+            clock (callable):  returns a monotonic time in seconds.
+
+        """
+        self.celery = celery
+        self.manifest = manifest
+        self.prefix = prefix
+        self.static = static
+        self.max_priority = max_priority
+        self.interval = interval
+        self.clock = clock
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def apply(self):
+        """
+        Generate routes and queues from the manifest and install them.
+        """
+        self.manifest.routes = generate_routes(self.manifest, prefix = self.prefix,
+                                               static = self.static)
+        queues = generate_queues(self.manifest.routes, max_priority = self.max_priority)
+        self.celery.conf.task_routes = self.manifest.routes
+        self.celery.conf.task_queues = queues
+
+        ## the router and queues of celery are built once, update them in place
+        amqp = self.celery.amqp
+        amqp.flush_routes()
+        amqp.router = amqp.Router()
+        for q in queues:
+            if q.name not in amqp.queues:
+                amqp.queues.add(q)
+        return self.manifest.routes
+
+    def refresh(self):
+        """
+        Refresh the manifest and regenerate the routes when plugins were
+        added, removed or modified.
+
+        Returns:
+            (bool):  True when the routes were regenerated.
+
+        """
+        with self._lock:
+            self._last = self.clock()
+            self.manifest.refresh()
+            if not self.manifest.changed:
+                return False
+            self.apply()
+            self.manifest.save()
+        logger.info("regenerated routes for plugins: " + ", ".join(self.manifest.changed))
+        return True
+
+    def maybe_refresh(self):
+        """
+        Refresh when interval seconds passed since the last refresh, cheap
+        enough to call on every request.
+        """
+        if self.clock() - self._last < self.interval:
+            return False
+        return self.refresh()
@@ -0,0 +1,438 @@
+# -*- coding: utf-8 -*-
+
+"""Deadline-aware scheduling of protocols with Autoprotocol time constraints."""
+
+from bisect import insort
+from datetime import datetime, timedelta, timezone
+import logging
+import threading
+
+from autoprotocol.unit import Unit
+from celery import chain, group
+
+from .campaign import _touched
+from .labstro import AutoprotocolToCelery
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def seconds(value):
+    """
+    Convert an Autoprotocol time e.g. "1.5:minute" to seconds.
+    """
+    return float(Unit(value).to("second").magnitude)
+
+
+def instruction_duration(instruction, default = 60.0):
+    """
+    Return the duration of an instruction in seconds, read from its
+    duration, or the duration of its mode_params, else default.
+    """
+    value = instruction.get("duration", None) or \
+        (instruction.get("mode_params", None) or {}).get("duration", None)
+    if value is None:
+        return default
+    return seconds(value)
+
+
+class InstrumentCalendar():
+    """
+    Reservations of instruments, each instrument has capacity lanes that
+    each run one instruction at a time.
+    """
+
+    def __init__(self, capacity = None):
+        """
+        Kwargs:
+            capacity (dict):  number of lanes per instrument, 1 by default.
+
+        """
+        self.capacity = capacity or {}
+        self._lanes = {}
+
+    def lanes(self, instrument):
+        if instrument not in self._lanes:
+            self._lanes[instrument] = [[] for _ in range(self.capacity.get(instrument, 1))]
+        return self._lanes[instrument]
+
+    def earliest(self, instrument, start, duration):
+        """
+        Return the earliest (start, lane) at or after start where instrument
+        is free for duration.
+        """
+        best = None
+        for n, lane in enumerate(self.lanes(instrument)):
+            t = start
+            for s, e in lane:
+                if t + duration <= s:
+                    break
+                t = max(t, e)
+            if best is None or t < best[0]:
+                best = (t, n)
+        return best
+
+    def reserve(self, instrument, lane, start, end):
+        insort(self.lanes(instrument)[lane], (start, end))
+
+    def release(self, before):
+        """
+        Drop the reservations ending at or before a time.
+        """
+        for lanes in self._lanes.values():
+            for n, lane in enumerate(lanes):
+                lanes[n] = [(s, e) for s, e in lane if e > before]
+
+    def shifted(self, offset):
+        """
+        Return a copy of the calendar with every reservation moved by offset.
+        """
+        calendar = InstrumentCalendar(self.capacity)
+        calendar._lanes = {i: [[(s + offset, e + offset) for s, e in lane] for lane in lanes]
+                           for i, lanes in self._lanes.items()}
+        return calendar
+
+
+class DeadlineScheduler():
+    """
+    Compute start times for the instructions of many protocols.
+
+    Instructions of a protocol run in order.  The time_constraints of each
+    protocol, e.g.::
+
+        "time_constraints": [{"from": {"instruction_end": 0},
+                              "to": {"instruction_start": 1},
+                              "less_than": "5:minute"}]
+
+    give every instruction a window [earliest, latest] of start times.
+    Instructions linked by less_than constraints form a unit.  At each step
+    the ready unit with the earliest deadline, across all protocols, is
+    placed at the first time its instruments are free, and delayed as a
+    whole when an instruction would miss its latest start, e.g. an
+    incubation is started later so the read following it finds the reader
+    free in time.  Starts still falling after their latest start, and
+    instructions whose own duration breaks a constraint between their start
+    and end, are reported as violations.
+
+    Reservations of dispatched schedules are kept in the calendar of the
+    scheduler, so later schedules plan around them, and released once their
+    planned end has passed.  The calendar is local to the process, and
+    reservations are kept until their planned end even when a protocol
+    fails or finishes early.
+
+    """
+
+    ## attempts at delaying a unit before placing it as early as possible
+    max_delays = 100
+
+    def __init__(self, instruments = None, capacity = None, default_duration = 60.0):
+        """
+        Kwargs:
+            instruments (dict):  instrument of each operation, the operation
+                name is used by default e.g. {"spin": "centrifuge-1"}.
+
+            capacity (dict):  concurrent instructions per instrument.
+
+            default_duration (float):  seconds assumed for instructions
+                without a duration.
+
+        """
+        self.instruments = instruments or {}
+        self.capacity = capacity or {}
+        self.default_duration = default_duration
+        ## reservations of dispatched schedules, in seconds since the epoch
+        self.calendar = InstrumentCalendar(self.capacity)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Build a scheduler from the LABSTRO_SCHEDULE_* settings.
+        """
+        return cls(instruments = config.get("LABSTRO_SCHEDULE_INSTRUMENTS", None),
+                   capacity = config.get("LABSTRO_SCHEDULE_CAPACITY", None),
+                   default_duration = config.get("LABSTRO_SCHEDULE_DEFAULT_DURATION", 60.0))
+
+    @staticmethod
+    def _endpoint(point, protocol):
+        """
+        Resolve a constraint endpoint to (instruction index, "start" or "end").
+        """
+        for kind in ("start", "end"):
+            if "instruction_" + kind in point:
+                return int(point["instruction_" + kind]), kind
+            if "ref_" + kind in point:
+                ref = point["ref_" + kind]
+                touching = [n for n, i in enumerate(protocol["instructions"])
+                            if ref in _touched(i, {ref})]
+                if not touching:
+                    raise ValueError("no instruction acts on ref " + ref)
+                return (touching[0] if kind == "start" else touching[-1]), kind
+        raise ValueError("unsupported time constraint endpoint: " + str(point))
+
+    def _constraints(self, protocol):
+        """
+        Index the constraints of a protocol by the instruction they bound.
+        """
+        bounds = {}
+        for c in protocol.get("time_constraints", []):
+            f = self._endpoint(c["from"], protocol)
+            t = self._endpoint(c["to"], protocol)
+            if f[0] > t[0] or (f[0] == t[0] and f[1] == "end" and t[1] == "start"):
+                raise ValueError("time constraint runs backwards: " + str(c))
+            bounds.setdefault(t[0], []).append((f, t[1], c))
+        return bounds
+
+    def _window(self, n, duration, times, bounds, ready):
+        """
+        Return the earliest and latest start of instruction n, and by how
+        many seconds its duration misses the constraints on itself.
+        """
+        earliest, latest, missed = ready, float("inf"), 0.0
+        for (f, f_kind), t_kind, c in bounds.get(n, []):
+            if f == n:
+                ## both ends on this instruction bound its duration, which
+                ## no start time can change
+                span = duration if (f_kind, t_kind) == ("start", "end") else 0.0
+                if "more_than" in c:
+                    missed = max(missed, seconds(c["more_than"]) - span)
+                if "less_than" in c:
+                    missed = max(missed, span - seconds(c["less_than"]))
+                continue
+            reference = times[f][0] if f_kind == "start" else times[f][1]
+            offset = duration if t_kind == "end" else 0.0
+            if "more_than" in c:
+                earliest = max(earliest, reference + seconds(c["more_than"]) - offset)
+            if "less_than" in c:
+                latest = min(latest, reference + seconds(c["less_than"]) - offset)
+        return earliest, latest, missed
+
+    @staticmethod
+    def _units(protocol, bounds):
+        """
+        Split the instructions of a protocol into units placed together,
+        instructions bound by a less_than constraint belong to one unit so
+        the unit can be delayed as a whole to meet it.
+
+        Returns:
+            (list):  [[instruction index, ...], ...]
+
+        """
+        last = list(range(len(protocol["instructions"])))
+        for n, constraints in bounds.items():
+            for (f, f_kind), t_kind, c in constraints:
+                if "less_than" in c and f < n:
+                    last[f] = max(last[f], n)
+        units, n = [], 0
+        while n < len(last):
+            end = last[n]
+            m = n
+            while m <= end:
+                end = max(end, last[m])
+                m += 1
+            units.append(list(range(n, end + 1)))
+            n = end + 1
+        return units
+
+    def _place(self, calendar, protocol, unit, times, bounds, ready, delay, stop = True):
+        """
+        Place a unit on a copy of calendar, the first instruction no earlier
+        than ready + delay.
+
+        Returns:
+            (InstrumentCalendar, list, float):  the calendar with the unit
+                reserved, a placement per instruction and by how many seconds
+                the first late instruction misses its latest start, 0 when
+                none is late.  With stop, placement ends at the first late
+                instruction.
+
+        """
+        calendar = calendar.shifted(0.0)
+        times = dict(times)
+        placed, late = [], 0.0
+        for n in unit:
+            i = protocol["instructions"][n]
+            duration = instruction_duration(i, self.default_duration)
+            earliest, latest, missed = self._window(n, duration, times, bounds, ready)
+            if n == unit[0]:
+                earliest = max(earliest, ready + delay)
+            instrument = self.instruments.get(i["op"], i["op"])
+            start, lane = calendar.earliest(instrument, earliest, duration)
+            calendar.reserve(instrument, lane, start, start + duration)
+            times[n] = (start, start + duration)
+            ready = start + duration
+            placed.append({"instruction": n, "op": i["op"], "instrument": instrument,
+                           "lane": lane, "start": start, "end": start + duration,
+                           "earliest": earliest, "latest": latest, "missed": missed})
+            if start > latest + 1e-9 and not late:
+                late = start - latest
+                if stop:
+                    break
+        return calendar, placed, late
+
+    def _schedule(self, protocols, now):
+        if not protocols:
+            raise ValueError("no protocols to schedule")
+
+        self.calendar.release(now.timestamp())
+        calendar = self.calendar.shifted(-now.timestamp())
+        bounds = {pid: self._constraints(p) for pid, p in protocols.items()}
+        units = {pid: self._units(p, bounds[pid]) for pid, p in protocols.items()}
+        times = {pid: {} for pid in protocols}
+        position = {pid: 0 for pid in protocols}
+        ready = {pid: 0.0 for pid in protocols}
+        entries, violations, reservations = [], [], []
+
+        while True:
+            candidates = []
+            for pid, p in protocols.items():
+                if position[pid] >= len(units[pid]):
+                    continue
+                n = units[pid][position[pid]][0]
+                duration = instruction_duration(p["instructions"][n], self.default_duration)
+                earliest, latest, missed = self._window(n, duration, times[pid], bounds[pid], ready[pid])
+                candidates.append((latest, earliest, pid))
+            if not candidates:
+                break
+
+            pid = min(candidates, key = lambda c: c[:2])[2]
+            unit = units[pid][position[pid]]
+
+            ## delay the whole unit, and with it the predecessors of a
+            ## constrained instruction, by how late that instruction would
+            ## start until every start meets its deadline, a unit that cannot
+            ## meet them is placed as early as possible
+            args = (protocols[pid], unit, times[pid], bounds[pid], ready[pid])
+            delay = 0.0
+            for _ in range(self.max_delays):
+                placement, placed, late = self._place(calendar, *args, delay)
+                if not late:
+                    break
+                delay += late
+            else:
+                placement, placed, late = self._place(calendar, *args, 0.0, stop = False)
+            calendar = placement
+
+            for e in placed:
+                n, start, end, latest = e["instruction"], e["start"], e["end"], e["latest"]
+                reservations.append((e["instrument"], e["lane"], start, end))
+                times[pid][n] = (start, end)
+                entry = {"protocol": pid, "instruction": n, "op": e["op"],
+                         "instrument": e["instrument"], "start": start,
+                         "end": end, "earliest": e["earliest"],
+                         "latest": None if latest == float("inf") else latest}
+                entries.append(entry)
+                if start > latest + 1e-9:
+                    violations.append(dict(entry, late = start - latest))
+                    logger.warning("protocol " + str(pid) + " instruction " + str(n) +
+                                   " starts " + str(start - latest) + "s after its deadline")
+                elif e["missed"] > 1e-9:
+                    violations.append(dict(entry, late = e["missed"]))
+                    logger.warning("protocol " + str(pid) + " instruction " + str(n) +
+                                   " misses a constraint on its duration by " + str(e["missed"]) + "s")
+            ready[pid] = placed[-1]["end"]
+            position[pid] += 1
+
+        if not entries:
+            raise ValueError("no instructions to schedule")
+        return Schedule(protocols, entries, violations, now, reservations)
+
+    def schedule(self, protocols, now = None, dispatch = None):
+        """
+        Schedule protocols around the reservations of dispatched schedules.
+
+        Args:
+            protocols (dict):  map of a protocol id to an Autoprotocol dict.
+
+        Kwargs:
+            now (datetime.datetime):  dispatch time, defaults to the current time.
+
+            dispatch (callable):  called with the schedule before the
+                calendar is unlocked, the instruments are reserved when it
+                returns True, so concurrent dispatches never share a lane.
+
+        Returns:
+            (Schedule)
+
+        Raises:
+            ValueError:  there is nothing to schedule or a time constraint
+                is invalid.
+
+        """
+        now = now or datetime.now(timezone.utc)
+        with self._lock:
+            schedule = self._schedule(protocols, now)
+            if dispatch is not None and dispatch(schedule):
+                self._reserve(schedule)
+        return schedule
+
+    def _reserve(self, schedule):
+        base = schedule.now.timestamp()
+        for instrument, lane, start, end in schedule.reservations:
+            self.calendar.reserve(instrument, lane, base + start, base + end)
+
+    def reserve(self, schedule):
+        """
+        Reserve the instruments for a dispatched schedule, later schedules
+        plan around it.  Prefer schedule(..., dispatch = ...) which cannot
+        race with another dispatch.
+        """
+        with self._lock:
+            self._reserve(schedule)
+
+
+class Schedule():
+    """
+    Start times computed by a DeadlineScheduler, in seconds from now.
+    """
+
+    def __init__(self, protocols, entries, violations, now = None, reservations = None):
+        self.protocols = protocols
+        self.entries = entries
+        self.violations = violations
+        self.now = now or datetime.now(timezone.utc)
+        self.reservations = reservations or []
+
+    @property
+    def feasible(self):
+        return not self.violations
+
+    @property
+    def makespan(self):
+        return max([e["end"] for e in self.entries] or [0.0])
+
+    def as_dict(self):
+        return {"entries": self.entries, "violations": self.violations,
+                "feasible": self.feasible, "makespan": self.makespan}
+
+    def to_celery(self, plugins, manifest = None, now = None):
+        """
+        Build a workflow releasing every instruction at its planned start
+        time with an ETA, one chain per protocol.
+
+        Args:
+            plugins (list): plugins to use for routing operations.
+
+        Kwargs:
+            manifest (labstro.manifest.PluginManifest):  route from the manifest.
+
+            now (datetime.datetime):  dispatch time, defaults to the time the
+                schedule was computed for.
+
+        Returns:
+            celery.canvas.Signature
+
+        """
+        now = now or self.now
+        starts = {(e["protocol"], e["instruction"]): e["start"] for e in self.entries}
+        chains = []
+        for pid, p in self.protocols.items():
+            if not p["instructions"]:
+                continue
+            workflow = AutoprotocolToCelery().to_celery(p, plugins, manifest = manifest)
+            tasks = [s.set(eta = now + timedelta(seconds = starts[(pid, n)]))
+                     for n, s in enumerate(workflow.tasks)]
+            chains.append(chain(tasks))
+        if not chains:
+            raise ValueError("no instructions to dispatch")
+        return group(chains) if len(chains) > 1 else chains[0]
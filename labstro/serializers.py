@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+"""Pluggable serialization for API responses and celery messages."""
+
+from decimal import Decimal
+import logging
+import timeit
+
+from flask import make_response
+from kombu.exceptions import SerializerNotInstalled
+from kombu.serialization import register, registry
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+ORJSON_CONTENT_TYPE = "application/x-orjson"
+
+
+def _default(obj):
+    """
+    Fallback for types orjson does not encode natively.
+    """
+    if isinstance(obj, Decimal):
+        return str(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if hasattr(obj, "isoformat"):
+        return obj.isoformat()
+    raise TypeError("Object of type " + type(obj).__name__ + " is not JSON serializable")
+
+
+def orjson_dumps(obj):
+    return orjson.dumps(obj, default = _default,
+                        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+
+def orjson_loads(s):
+    return orjson.loads(s)
+
+
+if orjson is not None:
+    register("orjson", orjson_dumps, orjson_loads,
+             content_type = ORJSON_CONTENT_TYPE, content_encoding = "binary")
+
+
+def available(name):
+    """
+    Return True if a kombu serializer is registered, e.g. "json", "orjson"
+    or "msgpack" (requires the msgpack package).
+    """
+    try:
+        registry.dumps(None, serializer = name)
+    except (SerializerNotInstalled, KeyError):
+        return False
+    return True
+
+
+def setup_celery(celery, name):
+    """
+    Use a serializer for celery task messages and results.  Every process
+    publishing or consuming the messages must use the same serializer, so
+    an unavailable serializer is an error rather than a silent switch.
+
+    Args:
+        celery (celery.Celery):  instance of a Celery application.
+
+        name (str):  "json", "orjson" or "msgpack".
+
+    Returns:
+        (str):  the serializer in use.
+
+    Raises:
+        ValueError:  the serializer is not installed.
+
+    """
+    if not available(name):
+        raise ValueError("serializer " + name + " is not available, install it or use json")
+
+    celery.conf.task_serializer = name
+    celery.conf.result_serializer = name
+    ## keep accepting json so messages queued before a switch still decode
+    celery.conf.accept_content = sorted(set(["json", name]))
+    celery.conf.result_accept_content = celery.conf.accept_content
+    return name
+
+
+def output_orjson(data, code, headers = None):
+    """
+    flask_restful representation encoding JSON responses with orjson.
+    """
+    resp = make_response(orjson_dumps(data) + b"\n", code)
+    resp.headers.extend(headers or {})
+    resp.headers["Content-Type"] = "application/json"
+    return resp
+
+
+def setup_flask(api, name):
+    """
+    Encode the JSON responses of a flask_restful Api with orjson when the
+    serializer is "orjson" or "msgpack", API clients always receive JSON.
+
+    Args:
+        api (flask_restful.Api):  the API.
+
+        name (str):  serializer setting.
+
+    """
+    if name in ("orjson", "msgpack") and orjson is not None:
+        api.representations["application/json"] = output_orjson
+
+
+def benchmark(payload = None, number = 1000):
+    """
+    Time encoding and decoding of a message with every available serializer,
+    e.g.::
+
+        python -c "from labstro.serializers import benchmark; print(benchmark())"
+
+    Kwargs:
+        payload (object):  message to serialize, defaults to the arguments of
+            a 96 instruction protocol as built by to_celery.
+
+        number (int):  iterations.
+
+    Returns:
+        (dict):  {serializer: {"dumps": seconds, "loads": seconds, "size": bytes}}
+
+    """
+    if payload is None:
+        refs = {"plate_" + str(n): {"new": "96-pcr", "store": {"where": "cold_4"}}
+                for n in range(8)}
+        payload = [[refs, {"op": "spin", "object": "plate_" + str(n % 8),
+                           "acceleration": "1000:g", "duration": "1:minute",
+                           "mode_params": {"temperature": "165:celsius"}}]
+                   for n in range(96)]
+
+    results = {}
+    for name in ("json", "orjson", "msgpack"):
+        if not available(name):
+            continue
+        codec = registry._encoders[name]
+        encoded = codec.encoder(payload)
+        decoder = registry._decoders[codec.content_type]
+        results[name] = {"dumps": timeit.timeit(lambda: codec.encoder(payload), number = number),
+                         "loads": timeit.timeit(lambda: decoder(encoded), number = number),
+                         "size": len(encoded)}
+    return results
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+"""Protocol execution traces and Chrome trace / Perfetto timeline export."""
+
+import json
+import logging
+import socket
+import threading
+import time
+
+from celery.signals import before_task_publish, task_prerun, task_postrun
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+## task headers set by labstro.labstro.AutoprotocolToCelery.to_celery
+PROTOCOL_HEADER = "labstro_protocol_id"
+INSTRUCTION_HEADER = "labstro_instruction"
+
+
+def trace_headers(protocol_id, instruction):
+    """
+    Return the task headers identifying an instruction of a protocol.
+    """
+    return {PROTOCOL_HEADER: protocol_id, INSTRUCTION_HEADER: instruction}
+
+
+def _request_header(request, key):
+    """
+    Read a custom header from a task request, headers are attributes of the
+    request on workers and kept in request.headers for eager execution.
+    """
+    value = getattr(request, key, None)
+    if value is None:
+        value = (getattr(request, "headers", None) or {}).get(key, None)
+    return value
+
+
+class LocalTraceStore():
+    """
+    Keep trace events in memory, for tests and labstro.local.LocalEngine.
+    """
+
+    def __init__(self):
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def add(self, protocol_id, event):
+        with self._lock:
+            self._events.setdefault(protocol_id, []).append(event)
+
+    def events(self, protocol_id):
+        with self._lock:
+            return list(self._events.get(protocol_id, []))
+
+    def trim(self, protocol_id, count = None):
+        """
+        Drop the first count events of a protocol, all of them by default.
+        """
+        with self._lock:
+            events = self._events.get(protocol_id, [])
+            del events[:count]
+            if not events:
+                self._events.pop(protocol_id, None)
+
+    def protocols(self):
+        with self._lock:
+            return sorted(self._events)
+
+
+class RedisTraceStore():
+    """
+    Keep trace events in a redis list per protocol, shared by the API and
+    the workers.
+    """
+
+    def __init__(self, client, prefix = "labstro:trace:", ttl = None):
+        """
+        Args:
+            client (redis.Redis):  redis client.
+
+        Kwargs:
+            prefix (str):  key prefix.
+
+            ttl (int):  seconds a trace is kept after its last event.
+
+        """
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        import redis
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def add(self, protocol_id, event):
+        key = self.prefix + protocol_id
+        with self.client.pipeline() as pipe:
+            pipe.rpush(key, json.dumps(event))
+            if self.ttl:
+                pipe.expire(key, self.ttl)
+            pipe.execute()
+
+    def events(self, protocol_id):
+        return [json.loads(e) for e in self.client.lrange(self.prefix + protocol_id, 0, -1)]
+
+    def trim(self, protocol_id, count = None):
+        """
+        Drop the first count events of a protocol, all of them by default,
+        events recorded since they were read are kept.
+        """
+        if count is None:
+            self.client.delete(self.prefix + protocol_id)
+        else:
+            ## redis removes the key once the list is empty
+            self.client.ltrim(self.prefix + protocol_id, count, -1)
+
+    def protocols(self):
+        keys = [k.decode() if isinstance(k, bytes) else k
+                for k in self.client.scan_iter(match = self.prefix + "*")]
+        return sorted(k[len(self.prefix):] for k in keys)
+
+
+class Tracer():
+    """
+    Record when each instruction of a traced protocol is queued, started and
+    finished, using celery signals.  Only tasks carrying the protocol headers
+    set by to_celery(protocol_id = ...) are recorded.
+
+    """
+
+    def __init__(self, store, clock = time.time):
+        """
+        Args:
+            store (LocalTraceStore or RedisTraceStore):  event storage.
+
+        Kwargs:
+            clock (callable):  returns the current time in seconds.
+
+        """
+        self.store = store
+        self.clock = clock
+        self.hostname = socket.gethostname()
+
+    def connect(self):
+        """
+        Connect the tracer to the celery signals of this process.
+        """
+        before_task_publish.connect(self.on_publish, weak = False)
+        task_prerun.connect(self.on_prerun, weak = False)
+        task_postrun.connect(self.on_postrun, weak = False)
+        return self
+
+    def disconnect(self):
+        before_task_publish.disconnect(self.on_publish)
+        task_prerun.disconnect(self.on_prerun)
+        task_postrun.disconnect(self.on_postrun)
+
+    def _add(self, protocol_id, event):
+        event["ts"] = self.clock()
+        try:
+            self.store.add(protocol_id, event)
+        except Exception as e:
+            ## tracing must never fail a task
+            logger.warning("unable to record trace event: " + str(e))
+
+    def on_publish(self, sender = None, headers = None, routing_key = None, **kwargs):
+        headers = headers or {}
+        protocol_id = headers.get(PROTOCOL_HEADER, None)
+        if protocol_id is None:
+            return
+        self._add(protocol_id, {"event": "queued",
+                                "task": sender,
+                                "task_id": headers.get("id", None),
+                                "instruction": headers.get(INSTRUCTION_HEADER, None),
+                                "queue": routing_key,
+                                "worker": self.hostname})
+
+    def _task_event(self, event, task_id, task, **extra):
+        request = getattr(task, "request", None)
+        protocol_id = _request_header(request, PROTOCOL_HEADER)
+        if protocol_id is None:
+            return
+        delivery_info = getattr(request, "delivery_info", None) or {}
+        data = {"event": event,
+                "task": task.name,
+                "task_id": task_id,
+                "instruction": _request_header(request, INSTRUCTION_HEADER),
+                "queue": delivery_info.get("routing_key", None),
+                "worker": getattr(request, "hostname", None) or self.hostname}
+        data.update(extra)
+        self._add(protocol_id, data)
+
+    def on_prerun(self, task_id = None, task = None, **kwargs):
+        self._task_event("started", task_id, task)
+
+    def on_postrun(self, task_id = None, task = None, state = None, **kwargs):
+        self._task_event("finished", task_id, task, state = state)
+
+
+def chrome_trace(protocol_id, events):
+    """
+    Convert trace events to the Chrome trace event format, which can be
+    opened with chrome://tracing or https://ui.perfetto.dev.
+
+    Each worker is a process whose threads are the instructions, execution
+    is drawn as a complete event and the time an instruction waited in its
+    queue as a separate "wait" event on the queue track.
+
+    Args:
+        protocol_id (str):  traced protocol.
+
+        events (list):  events recorded by a Tracer.
+
+    Returns:
+        (dict):  {"traceEvents": [...], "metadata": {...}}
+
+    """
+    tasks = {}
+    for e in events:
+        t = tasks.setdefault(e["task_id"], {"task": e["task"], "instruction": e["instruction"]})
+        t[e["event"]] = e["ts"]
+        for k in ("queue", "worker", "state"):
+            if e.get(k, None) is not None and (k != "worker" or e["event"] != "queued"):
+                t[k] = e[k]
+
+    def us(ts):
+        return int(round(ts * 1e6))
+
+    pids = {"queues": 0}
+    trace = []
+    for task_id, t in sorted(tasks.items(), key = lambda i: i[1].get("queued", i[1].get("started", 0))):
+        instruction = t["instruction"] if t["instruction"] is not None else -1
+        name = t["task"].rsplit(".", 1)[-1]
+        args = {"task_id": task_id, "task": t["task"], "instruction": instruction,
+                "queue": t.get("queue", None), "worker": t.get("worker", None),
+                "state": t.get("state", None)}
+
+        if "queued" in t and "started" in t:
+            trace.append({"name": "wait " + name, "cat": "wait", "ph": "X",
+                          "ts": us(t["queued"]), "dur": us(t["started"] - t["queued"]),
+                          "pid": 0, "tid": instruction, "args": args})
+        if "started" in t:
+            worker = t.get("worker", None) or "unknown"
+            pid = pids.setdefault(worker, len(pids))
+            end = t.get("finished", t["started"])
+            trace.append({"name": name, "cat": "task", "ph": "X",
+                          "ts": us(t["started"]), "dur": us(end - t["started"]),
+                          "pid": pid, "tid": instruction, "args": args})
+
+    for name, pid in pids.items():
+        trace.append({"name": "process_name", "ph": "M", "pid": pid, "tid": 0,
+                      "args": {"name": name}})
+
+    return {"traceEvents": trace,
+            "displayTimeUnit": "ms",
+            "metadata": {"protocol_id": protocol_id}}
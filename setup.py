@@ -39,6 +39,9 @@ setup(
         'console_scripts': [
             'labstro=labstro.cli:main',
         ],
+        'labstro.plugins': [
+            'simulation = labstro.plugins.simulation',
+        ],
     },
     install_requires=requirements,
     license="GNU General Public License v3",
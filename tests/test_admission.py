@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `labstro.api.admission` module."""
+
+
+import unittest
+
+from celery import Celery
+from flask import Flask
+from flask_restful import Api
+
+from labstro.api import apiv1
+from labstro.api.admission import AdmissionControl, LocalLimiter
+
+
+class TestAdmission(unittest.TestCase):
+    """Tests for `labstro.api.admission` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.now = 0.0
+        self.celery = Celery("test", broker = "memory://")
+        self.depths = {"celery": 0}
+
+    def clock(self):
+        return self.now
+
+    def test_local_limiter(self):
+        limiter = LocalLimiter(rate = 2, burst = 2, clock = self.clock)
+
+        assert limiter.consume("a") == (True, 0.0)
+        assert limiter.consume("a") == (True, 0.0)
+        assert limiter.consume("a") == (False, 0.5)
+        assert limiter.consume("b")[0]
+
+        self.now = 0.5
+        assert limiter.consume("a")[0]
+
+    def test_local_limiter_eviction(self):
+        limiter = LocalLimiter(rate = 2, burst = 2, clock = self.clock)
+        for n in range(100):
+            limiter.consume("client-" + str(n))
+        assert len(limiter) == 100
+
+        ## every bucket refilled after burst / rate seconds
+        self.now = 1.0
+        limiter.consume("a")
+        limiter.consume("a")
+        assert len(limiter) == 1
+        assert limiter.consume("a")[0] is False
+
+    def test_admit_many(self):
+        admission = AdmissionControl(self.celery,
+                                     client_limiter = LocalLimiter(rate = 1, burst = 4, clock = self.clock))
+        ## larger than the bucket, takes all of it
+        assert admission.admit_many("lab-1", {"labstro.plugins.simulation.seal": 3,
+                                              "labstro.plugins.simulation.spin": 3}) is None
+        assert admission.admit("lab-1", "labstro.plugins.simulation.seal")[1] == 429
+
+    def test_queue_depth(self):
+        admission = AdmissionControl(self.celery, max_queue_depth = 10, depth_ttl = 0,
+                                     queue_depth = self.depths.get)
+        assert admission.admit("lab-1", "labstro.plugins.simulation.seal") is None
+
+        self.depths["celery"] = 11
+        body, code, headers = admission.admit("lab-1", "labstro.plugins.simulation.seal")
+        assert code == 429
+        assert headers["Retry-After"] == "5"
+
+    def test_apply_async_rate_limited(self):
+        limiter = LocalLimiter(rate = 1, burst = 1, clock = self.clock)
+        limiter.consume("client:10.0.0.7")
+        app = Flask("test")
+        apiv1.setup_api(Api(app), self.celery,
+                        admission = AdmissionControl(self.celery, client_limiter = limiter))
+
+        ## a client chosen identity does not give a fresh bucket
+        r = app.test_client().post("/apiv1/task/apply_async/labstro.plugins.simulation.seal",
+                                   json = {"args": []}, headers = {"X-Client-Id": "lab-2"},
+                                   environ_base = {"REMOTE_ADDR": "10.0.0.7"})
+        assert r.status_code == 429
+        assert r.headers["Retry-After"] == "1"
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `labstro.api.apiv1` module."""
+
+
+import unittest
+
+from celery import Celery
+from flask import Flask
+from flask_restful import Api
+
+from labstro.api import apiv1
+from labstro.tracing import LocalTraceStore
+
+
+class PipelineClient():
+    """Redis client stand-in supporting the calls made by store_results."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key, None)
+
+    def mget(self, keys):
+        return [self.data.get(k, None) for k in keys]
+
+    def set(self, key, value, *args):
+        self.data[key] = value
+
+    def setex(self, key, ttl, value):
+        self.data[key] = value
+
+    def publish(self, key, value):
+        pass
+
+    def pipeline(self):
+        return self
+
+    def execute(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class TestApiv1(unittest.TestCase):
+    """Tests for `labstro.api.apiv1` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.celery = Celery("test", broker = "memory://",
+                             backend = "cache+memory://")
+        app = Flask("test")
+        apiv1.setup_api(Api(app), self.celery)
+        self.client = app.test_client()
+
+    def test_task_priority(self):
+        assert apiv1.task_priority({"args": []}) is None
+        assert apiv1.task_priority({"priority": 3}, max_priority = 10) == 3
+        assert apiv1.task_priority({"priority": 42}, max_priority = 10) == 10
+        assert apiv1.task_priority({"priority": -1}) == 0
+
+    def test_bulk_update(self):
+        body = {"transitions": [{"task_id": "t1", "state": "started"},
+                                {"task_id": "t2", "state": "success", "result": 42},
+                                {"task_id": "t3", "state": "failed", "result": "jam"}],
+                "read_back": True}
+        r = self.client.post("/apiv1/task/bulk", json = body)
+
+        assert r.status_code == 200
+        assert r.json["stored"] == ["t1", "t2", "t3"]
+        assert [d["state"] for d in r.json["results"]] == ["STARTED", "SUCCESS", "FAILED"]
+        assert self.celery.AsyncResult("t2").result == 42
+
+    def test_bulk_update_pipeline(self):
+        backend = self.celery.backend
+        backend.__dict__["client"] = PipelineClient()
+        stored, skipped = apiv1.store_results(backend, [("t5", "SUCCESS", 42), ("t6", "STARTED", None)])
+        assert stored == ["t5", "t6"]
+
+        piped = backend.get_task_meta("t5")
+        backend.store_result("t7", 42, "SUCCESS")
+        direct = backend.get_task_meta("t7")
+        assert piped["date_done"] is not None
+        assert sorted(piped) == sorted(direct)
+
+        stored, skipped = apiv1.store_results(backend, [("t5", "FAILED", "jam")])
+        assert skipped == ["t5"]
+
+        ## a success earlier in the same batch is not overwritten
+        stored, skipped = apiv1.store_results(backend, [("t8", "SUCCESS", 1), ("t8", "FAILED", "jam")])
+        assert (stored, skipped) == (["t8"], ["t8"])
+        assert backend.get_task_meta("t8")["status"] == "SUCCESS"
+
+    def test_bulk_update_invalid(self):
+        body = {"transitions": [{"task_id": "t1", "state": "sleeping"}]}
+        r = self.client.post("/apiv1/task/bulk", json = body)
+
+        assert r.status_code == 400
+
+    def test_skip_read_back(self):
+        r = self.client.post("/apiv1/task/success/t4?read_back=false", json = {"od": 0.5})
+
+        assert r.json == {"task_id": "t4"}
+        assert self.celery.AsyncResult("t4").state == "SUCCESS"
+
+    def test_task_list_etag(self):
+        @self.celery.task(name = "labstro.plugins.testing.seal")
+        def seal():
+            return True
+
+        r = self.client.get("/apiv1/tasks?plugin=labstro.plugins.testing")
+        assert r.status_code == 200
+        assert r.json == ["labstro.plugins.testing.seal"]
+
+        r = self.client.get("/apiv1/tasks?plugin=labstro.plugins.testing",
+                            headers = {"If-None-Match": r.headers["ETag"]})
+        assert r.status_code == 304
+
+        @self.celery.task(name = "labstro.plugins.testing.spin")
+        def spin():
+            return True
+
+        r = self.client.get("/apiv1/tasks?plugin=labstro.plugins.testing",
+                            headers = {"If-None-Match": r.headers["ETag"]})
+        assert r.status_code == 200
+        assert len(r.json) == 2
+
+    def test_task_routes_edited(self):
+        """Routes edited in place are served without invalidating the index."""
+        self.celery.conf.task_routes = {"labstro.plugins.simulation.*": {"queue": "labstro-simulation"}}
+        r = self.client.get("/apiv1/task/routes")
+        etag = r.headers["ETag"]
+
+        self.celery.conf.task_routes["labstro.plugins.other.*"] = {"queue": "other"}
+        r = self.client.get("/apiv1/task/routes", headers = {"If-None-Match": etag})
+        assert r.status_code == 200
+        assert "labstro.plugins.other.*" in r.json
+
+    def test_task_routes_filter(self):
+        self.celery.conf.task_routes = {"labstro.plugins.simulation.*": {"queue": "labstro-simulation"},
+                                        "labstro.plugins.other.*": {"queue": "other"}}
+        r = self.client.get("/apiv1/task/routes?queue=other")
+
+        assert r.json == {"labstro.plugins.other.*": {"queue": "other"}}
+
+    def test_protocol_trace(self):
+        store = LocalTraceStore()
+        store.add("p1", {"event": "started", "task": "labstro.plugins.simulation.seal",
+                         "task_id": "t1", "instruction": 0, "worker": "w1", "ts": 1.0})
+        store.add("p1", {"event": "finished", "task": "labstro.plugins.simulation.seal",
+                         "task_id": "t1", "instruction": 0, "worker": "w1", "ts": 2.5,
+                         "state": "SUCCESS"})
+        app = Flask("test")
+        apiv1.setup_api(Api(app), self.celery, trace_store = store)
+        client = app.test_client()
+
+        r = client.get("/apiv1/protocol/trace/p1")
+        assert [e["dur"] for e in r.json["traceEvents"] if e["ph"] == "X"] == [1500000]
+        assert client.get("/apiv1/protocol/trace/p2").status_code == 404
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `labstro.campaign` module."""
+
+
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from celery import Celery
+from flask import Flask
+from flask_restful import Api
+
+from labstro.api import apiv1
+from labstro.api.admission import AdmissionControl, LocalLimiter
+from labstro.campaign import CampaignCompiler
+from labstro.local import LocalEngine
+
+
+def qc_protocol(plate):
+    return {"refs": {"reagent": {"id": "ct-reagent", "store": {"where": "cold_4"}},
+                     plate: {"new": "96-pcr", "discard": True}},
+            "instructions": [
+                {"op": "spin", "object": "reagent", "acceleration": "1000:g", "duration": "1:minute"},
+                {"op": "dispense", "object": plate, "reagent_source": "reagent/A1",
+                 "columns": [{"column": 0, "volume": "10:microliter"}]},
+                {"op": "seal", "object": plate, "type": "foil"}]}
+
+
+class TestCampaignCompiler(unittest.TestCase):
+    """Tests for `labstro.campaign` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.plugins = ["labstro.plugins.simulation"]
+        self.protocols = {"qc-1": qc_protocol("plate"), "qc-2": qc_protocol("plate")}
+
+    def test_merge(self):
+        plan = CampaignCompiler(self.plugins).merge(self.protocols)
+
+        assert plan.stats() == {"instructions": 6, "steps": 5, "deduplicated": 1, "stages": 4}
+        assert sorted(plan.refs) == ["plate", "qc-2:plate", "reagent"]
+        assert plan.steps[0]["protocols"] == ["qc-1", "qc-2"]
+        assert plan.steps[3]["instruction"]["object"] == "qc-2:plate"
+        assert plan.steps[3]["refs"] == ["qc-2:plate", "reagent"]
+        assert plan.steps[4]["refs"] == ["qc-2:plate"]
+        assert plan.stages == [[0], [1], [2, 3], [4]]
+
+    def test_merge_keeps_protocol_order(self):
+        """A protocol step follows its own steps preceding a merged step."""
+        a = {"refs": {"reagent": {"id": "ct-reagent"}, "pa": {"new": "96-pcr"}},
+             "instructions": [{"op": "spin", "object": "reagent"},
+                              {"op": "seal", "object": "pa"}]}
+        b = {"refs": {"reagent": {"id": "ct-reagent"}, "pb": {"new": "96-pcr"}},
+             "instructions": [{"op": "seal", "object": "pb"},
+                              {"op": "seal", "object": "pb"},
+                              {"op": "spin", "object": "reagent"},
+                              {"op": "spin", "object": "pb"}]}
+        plan = CampaignCompiler(self.plugins).merge({"a": a, "b": b})
+
+        assert plan.steps[4]["instruction"] == {"op": "spin", "object": "pb"}
+        assert plan.steps[4]["depends"] == [0, 3]
+        assert plan.stages == [[0, 2], [1, 3], [4]]
+
+    def test_execute(self):
+        compiler = CampaignCompiler(self.plugins)
+        workflow = compiler.to_celery(compiler.merge(self.protocols))
+
+        with LocalEngine() as engine:
+            assert engine.apply(workflow).state == "SUCCESS"
+
+    def test_api(self):
+        app = Flask("test")
+        apiv1.setup_api(Api(app), Celery("test", broker = "memory://"))
+
+        r = app.test_client().post("/apiv1/campaign",
+                                   json = {"protocols": self.protocols, "plugins": self.plugins})
+        assert r.json["stats"]["deduplicated"] == 1
+
+    def test_api_dispatch(self):
+        app = Flask("test")
+        celery = Celery("test", broker = "memory://")
+        celery.conf["LABSTRO_TASK_QUEUE_MAX_PRIORITY"] = 10
+        admission = AdmissionControl(celery, task_limiter = LocalLimiter(1.0, 3))
+        apiv1.setup_api(Api(app), celery, admission = admission)
+        client = app.test_client()
+
+        r = client.post("/apiv1/campaign", json = {"protocols": {}, "dispatch": True})
+        assert r.status_code == 400
+
+        with mock.patch("celery.canvas._chain.apply_async", autospec = True,
+                        return_value = SimpleNamespace(id = "c1")) as apply_async:
+            r = client.post("/apiv1/campaign", json = {"protocols": self.protocols, "plugins": self.plugins,
+                                                       "priority": 99, "dispatch": True})
+        assert r.json["task-id"] == "c1"
+        workflow = apply_async.call_args[0][0]
+        assert workflow.tasks[0].options["priority"] == 10
+
+        ## the task buckets of the campaign are spent
+        r = client.post("/apiv1/campaign", json = {"protocols": self.protocols, "plugins": self.plugins,
+                                                   "dispatch": True})
+        assert r.status_code == 429
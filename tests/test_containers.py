@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `labstro.containers` module."""
+
+
+import os
+import unittest
+
+from labstro.labstro import AutoprotocolToCelery
+from labstro.containers import ContainerRegistry
+
+
+class TestContainerRegistry(unittest.TestCase):
+    """Tests for `labstro.containers` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.protocol_path = os.path.join(os.path.dirname(__file__), "protocol.json")
+        self.refs = {"plate_1": {"new": "96-pcr", "discard": True},
+                     "plate_2": {"id": "ct123", "cont_type": "96-flat",
+                                 "store": {"where": "cold_4"}}}
+
+    def test_from_json(self):
+        registry, p = AutoprotocolToCelery.from_json(self.protocol_path)
+
+        assert len(registry) == 1
+        assert registry.get("test pcr plate").container_type.shortname == "96-pcr"
+        assert "test pcr plate" in p.refs
+
+    def test_indexes(self):
+        registry = ContainerRegistry.from_refs(self.refs)
+
+        assert registry.get_by_id("ct123") is registry.get("plate_2")
+        assert registry.in_storage("cold_4") == [registry.get("plate_2")]
+
+    def test_resolve_known_id(self):
+        registry = ContainerRegistry.from_refs(self.refs)
+        c = registry.resolve_ref("plate_3", {"id": "ct123"})
+
+        assert c.container_type.shortname == "96-flat"
+
+    def test_resolve_unknown(self):
+        registry = ContainerRegistry()
+
+        with self.assertRaises(ValueError):
+            registry.resolve_ref("plate_4", {"id": "unknown"})
+
+    def test_inventory(self):
+        refs = {"reagent": {"id": "ct1abc", "store": {"where": "cold_4"}},
+                "other": {"id": "ct1abd", "store": {"where": "cold_4"}}}
+        registry = ContainerRegistry.from_refs(refs, inventory = {"ct1abc": "micro-1.5"})
+
+        assert registry.get("reagent").container_type.shortname == "micro-1.5"
+        assert "other" not in registry
+        assert registry.unresolved == {"other": refs["other"]}
+
+    def test_replace(self):
+        registry = ContainerRegistry.from_refs(self.refs)
+        registry.resolve_ref("plate_2", {"id": "ct456", "cont_type": "96-flat"})
+
+        assert registry.get_by_id("ct123") is None
+        assert registry.get_by_id("ct456") is registry.get("plate_2")
@@ -88,3 +88,9 @@ class TestAutoprotocolToCelery(unittest.TestCase):
 
 
          assert result == getattr(self.plugin_module, "seal")
+
+    def test_to_celery_priority(self):
+        result = AutoprotocolToCelery().to_celery(self.protocol_dict,
+                                       self.plugins, priority = 9)
+
+        assert [t.options["priority"] for t in result.tasks] == [9, 9]
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `labstro.loadtest` module."""
+
+
+import unittest
+
+from click.testing import CliRunner
+
+from labstro import loadtest
+
+
+class TestLoadGenerator(unittest.TestCase):
+    """Tests for `labstro.loadtest` module."""
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        assert loadtest.percentile(values, 50) == 50
+        assert loadtest.percentile(values, 99) == 99
+        assert loadtest.percentile([], 50) is None
+
+    def test_run(self):
+        app, celery = loadtest.standin_app()
+        self.addCleanup(celery.labstro_tracer.disconnect)
+        report = loadtest.LoadGenerator(app, celery, failure_rate = 0.5, seed = 1).run(
+            iterations = 5, concurrency = 2, warmup = 1)
+
+        endpoints = report["endpoints"]
+        assert report["requests"] == 50
+        assert endpoints["apply_async"]["count"] == 10
+        assert endpoints["result"]["count"] == 20
+        assert endpoints["success"]["count"] + endpoints["failed"]["count"] == 10
+        assert sum(e["errors"] for e in endpoints.values()) == 0
+        assert sorted(report["stages"]) == ["backend read", "backend write", "publish"]
+        assert report["stages"]["publish"]["count"] == 10
+        ## instrumentation is removed after the run
+        assert "send_task" not in vars(celery)
+
+    def test_command_line_interface(self):
+        result = CliRunner().invoke(loadtest.main, ["--iterations", "2", "--concurrency", "1"])
+        assert result.exit_code == 0
+        assert "apply_async" in result.output
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `labstro.local` module."""
+
+
+import os
+import json
+import threading
+import time
+import unittest
+
+from celery import group, shared_task
+
+from labstro.labstro import AutoprotocolToCelery
+from labstro.local import LocalEngine
+from labstro.plugins.simulation import seal, spin
+
+
+@shared_task
+def jam(*args, **kwargs):
+    raise RuntimeError("plate jammed")
+
+
+release = threading.Event()
+
+
+@shared_task
+def hold(*args, **kwargs):
+    release.wait(5)
+    return True
+
+
+class TestLocalEngine(unittest.TestCase):
+    """Tests for `labstro.local` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        with open(os.path.join(os.path.dirname(__file__), "protocol.json"), "r") as f:
+            self.protocol_dict = json.load(f)
+        self.plugins = ["labstro.plugins.simulation"]
+        self.engine = LocalEngine(max_workers = 4)
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self.engine.shutdown()
+
+    def test_chain(self):
+        sig = AutoprotocolToCelery().to_celery(self.protocol_dict, self.plugins)
+        r = self.engine.apply(sig)
+
+        assert r.state == "SUCCESS"
+        assert r.get() is True
+
+    def test_group(self):
+        sig = AutoprotocolToCelery().to_celery(self.protocol_dict, self.plugins)
+        r = self.engine.apply(group([sig, spin.s()]))
+
+        assert r.result == [True, True]
+
+    def test_failure_stops_chain(self):
+        last = spin.s().set(task_id = "last")
+        r = self.engine.apply(seal.s() | jam.s() | last)
+
+        assert r.state == "FAILURE"
+        assert "plate jammed" in r.result
+        assert self.engine.AsyncResult("last").state == "PENDING"
+
+    def test_started_when_executed(self):
+        engine = LocalEngine(max_workers = 1)
+        try:
+            release.clear()
+            r = engine.apply_async(group([hold.s().set(task_id = "first"),
+                                          seal.s().set(task_id = "second")]))
+            while engine.AsyncResult("first").state != "STARTED":
+                time.sleep(0.01)
+            ## queued behind the held task, not started
+            assert engine.states["second"][0] == "PENDING"
+
+            release.set()
+            r.get()
+            assert engine.AsyncResult("second").state == "SUCCESS"
+        finally:
+            release.set()
+            engine.shutdown()
+
+    def test_max_results(self):
+        engine = LocalEngine(max_workers = 2, max_results = 10)
+        try:
+            results = [engine.apply(spin.s()) for _ in range(20)]
+            assert len(engine.states) <= 10
+            assert not engine._futures
+            assert results[-1].state == "SUCCESS"
+
+            results[-1].forget()
+            assert results[-1].state == "PENDING"
+        finally:
+            engine.shutdown()
+
+    def test_process_mode(self):
+        with LocalEngine(max_workers = 2, mode = "process") as engine:
+            r = engine.apply(seal.s() | spin.s())
+            assert r.state == "SUCCESS"
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `labstro.manifest` module."""
+
+
+import os
+import json
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from labstro.labstro import AutoprotocolToCelery
+from labstro.manifest import PluginManifest, scan_module
+
+
+class TestPluginManifest(unittest.TestCase):
+    """Tests for `labstro.manifest` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "manifest.json")
+        self.plugins = ["labstro.plugins.simulation"]
+        self.routes = {'labstro.plugins.simulation.*': {'queue': 'labstro-simulation'}}
+        with open(os.path.join(os.path.dirname(__file__), "protocol.json"), "r") as f:
+            self.protocol_dict = json.load(f)
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self.tmp)
+
+    def test_scan_module(self):
+        result = scan_module("labstro.plugins.simulation")
+
+        assert result["operations"] == {"dispense": "labstro.plugins.simulation.dispense",
+                                        "seal": "labstro.plugins.simulation.seal",
+                                        "spin": "labstro.plugins.simulation.spin"}
+
+    def test_scan_class_tasks(self):
+        with open(os.path.join(self.tmp, "labstro_test_reader.py"), "w") as f:
+            f.write("from labstro.plugins.generic import PlugInTask\n"
+                    "class Read(PlugInTask):\n"
+                    "    name = 'labstro_test_reader.absorbance'\n"
+                    "    def run(self, *args, **kwargs):\n"
+                    "        return True\n")
+        sys.path.insert(0, self.tmp)
+        try:
+            result = scan_module("labstro_test_reader")
+        finally:
+            sys.path.remove(self.tmp)
+
+        assert result["operations"] == {"absorbance": "labstro_test_reader.absorbance"}
+        assert result["mtime"] is not None
+
+    def test_refresh(self):
+        PluginManifest(self.path, plugins = self.plugins, routes = self.routes).refresh()
+        manifest = PluginManifest(self.path, routes = self.routes).load()
+        assert os.listdir(self.tmp) == ["manifest.json"]
+
+        assert manifest.tasks()["labstro.plugins.simulation.seal"]["queue"] == "labstro-simulation"
+        assert manifest.route(["seal", "spin"], self.plugins) == \
+            AutoprotocolToCelery.route_plugins(["seal", "spin"], self.plugins)
+
+    def test_save_unchanged(self):
+        """Refreshing an unchanged manifest does not write it."""
+        PluginManifest(self.path, plugins = self.plugins, routes = self.routes).refresh()
+        with mock.patch("os.replace", side_effect = OSError("read-only file system")) as replace:
+            manifest = PluginManifest(self.path, plugins = self.plugins, routes = self.routes).refresh()
+            manifest.save()
+            assert manifest.changed == []
+            assert replace.call_count == 0
+
+            ## a manifest that cannot be written is kept in memory
+            manifest.routes = {}
+            manifest.save()
+            assert replace.call_count == 1
+            assert manifest.tasks()["labstro.plugins.simulation.seal"]["queue"] is None
+
+    def test_to_celery(self):
+        manifest = PluginManifest(plugins = self.plugins).refresh()
+        result = AutoprotocolToCelery().to_celery(self.protocol_dict, self.plugins,
+                                                  manifest = manifest)
+
+        assert [t.task for t in result.tasks] == ["labstro.plugins.simulation.seal",
+                                                  "labstro.plugins.simulation.spin"]
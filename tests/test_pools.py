@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `labstro.pools` module."""
+
+
+import os
+import unittest
+
+from celery import Celery
+
+from labstro.pools import ConnectionPools
+
+
+class TestConnectionPools(unittest.TestCase):
+    """Tests for `labstro.pools` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.celery = Celery("test", broker = "memory://")
+        self.celery.conf.broker_pool_limit = 2
+        self.pools = ConnectionPools(self.celery)
+
+    def test_producer(self):
+        for _ in range(3):
+            with self.pools.producer() as producer:
+                self.celery.send_task("labstro.plugins.simulation.seal",
+                                      producer = producer)
+
+        stats = self.pools.stats()
+        assert stats["broker"]["limit"] == 2
+        assert stats["broker"]["acquired"] == 3
+        assert stats["broker"]["in_use"] == 0
+
+    def test_reset(self):
+        with self.pools.producer():
+            pass
+        self.pools.reset()
+
+        assert self.pools.stats()["forks"] == 1
+        assert self.pools.stats()["broker"]["in_use"] == 0
+
+    def test_fork(self):
+        if not hasattr(os, "fork"):
+            return
+        with self.pools.producer():
+            pass
+        pid = os.fork()
+        if pid == 0:
+            stats = self.pools.stats()
+            os._exit(0 if stats["forks"] == 1 and stats["broker"]["acquired"] == 0 else 1)
+        assert os.waitpid(pid, 0)[1] == 0
+        assert self.pools.stats()["forks"] == 0
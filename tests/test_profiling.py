@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `labstro.profiling` module."""
+
+
+import pstats
+import shutil
+import tempfile
+import unittest
+
+from celery import Celery
+from flask import Flask
+from flask_restful import Api
+
+from labstro.api import apiv1
+from labstro.profiling import TaskProfiler
+
+
+class TestTaskProfiler(unittest.TestCase):
+    """Tests for `labstro.profiling` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.tmp = tempfile.mkdtemp()
+        self.profiler = TaskProfiler(self.tmp, tasks = ["labstro.plugins.simulation.spin"],
+                                     keep = 2, random = lambda: 0.5)
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self.tmp)
+
+    def test_should_profile(self):
+        assert self.profiler.should_profile("labstro.plugins.simulation.spin")
+        assert not self.profiler.should_profile("labstro.plugins.simulation.seal")
+
+        self.profiler.configure(sample_rate = 0.6)
+        assert self.profiler.should_profile("labstro.plugins.simulation.seal")
+
+    def test_shared_config(self):
+        """A change made in one process reaches profilers sharing the directory."""
+        worker = TaskProfiler(self.tmp, reload_interval = 0.0)
+        assert not worker.enabled
+
+        self.profiler.configure(tasks = ["labstro.plugins.simulation.seal"])
+        assert worker.enabled
+        assert worker.should_profile("labstro.plugins.simulation.seal")
+        assert not worker.should_profile("labstro.plugins.simulation.spin")
+        assert [p["name"] for p in worker.list()] == []
+
+    def test_run(self):
+        for task_id in ["t1", "t2", "t3"]:
+            result = self.profiler.run("labstro.plugins.simulation.spin", task_id,
+                                       sorted, [3, 1, 2])
+            assert result == [1, 2, 3]
+
+        profiles = self.profiler.list()
+        assert len(profiles) == 2
+        assert profiles[0]["task"] == "labstro.plugins.simulation.spin"
+        pstats.Stats(self.profiler.path(profiles[0]["name"]))
+
+    def test_api(self):
+        self.profiler.run("labstro.plugins.simulation.spin", "t1", sorted, [])
+        name = self.profiler.list()[0]["name"]
+        app = Flask("test")
+        apiv1.setup_api(Api(app), Celery("test", broker = "memory://"),
+                        profiler = self.profiler)
+        client = app.test_client()
+
+        assert client.get("/apiv1/profiles").json["profiles"][0]["name"] == name
+        assert client.get("/apiv1/profiles/" + name).status_code == 200
+        assert client.get("/apiv1/profiles/..%2Fsecret.prof").status_code == 404
+
+        r = client.put("/apiv1/profiles", json = {"sample_rate": 0.1})
+        assert r.json["config"]["sample_rate"] == 0.1
+
+        for body in ({"tasks": "abc"}, {"sample_rate": "often"}, {"sample_rate": 2}, ["spin"]):
+            assert client.put("/apiv1/profiles", json = body).status_code == 400
+        assert client.get("/apiv1/profiles").json["config"] == {"tasks": ["labstro.plugins.simulation.spin"], "sample_rate": 0.1}
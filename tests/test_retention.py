@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `labstro.retention` module."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from celery import Celery
+from flask import Flask
+from flask_restful import Api
+
+from labstro.api import apiv1
+from labstro.retention import (LocalSummaryStore, ResultArchive, ResultRetention,
+                               RetentionPolicy)
+from labstro.tracing import LocalTraceStore
+
+
+class TestRetention(unittest.TestCase):
+    """Tests for `labstro.retention` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.directory = tempfile.mkdtemp()
+        self.now = 1000.0
+        self.celery = Celery("test", broker = "memory://", backend = "cache+memory://")
+        self.traces = LocalTraceStore()
+        self.retention = ResultRetention(self.celery, self.traces, LocalSummaryStore(),
+                                         ResultArchive(self.directory),
+                                         compact_after = 600, archive_after = 3600,
+                                         clock = lambda: self.now)
+
+        for n, (task_id, ts) in enumerate([("r-t1", 100.0), ("r-t2", 200.0)]):
+            for event in ("queued", "started", "finished"):
+                self.traces.add("elisa-1", {"event": event, "task": "labstro.plugins.simulation.spin",
+                                            "task_id": task_id, "instruction": n, "ts": ts})
+            self.celery.backend.mark_as_done(task_id, {"od600": n})
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self.directory)
+
+    def test_policy(self):
+        policy = RetentionPolicy(default = 3600,
+                                 tasks = {"labstro.plugins.simulation.*": 60},
+                                 queues = {"labstro-plate-reader": 600})
+        assert policy.ttl("labstro.plugins.simulation.spin", "labstro-simulation") == 60
+        assert policy.ttl("labstro.plugins.reader.read", "labstro-plate-reader") == 600
+        assert policy.ttl("labstro.plugins.reader.read", "celery") == 3600
+
+    def test_postrun_ttl(self):
+        backend = mock.Mock(expires = 3600, get_key_for_task = lambda task_id: "key-" + task_id)
+        retention = ResultRetention(SimpleNamespace(backend = backend), self.traces, None, None,
+                                    policy = RetentionPolicy(default = 3600, tasks = {"*.spin": 60}))
+        task = SimpleNamespace(name = "labstro.plugins.simulation.spin",
+                               request = SimpleNamespace(delivery_info = {"routing_key": "labstro-simulation"}))
+
+        retention.on_postrun(task_id = "t1", task = task)
+        backend.expire.assert_called_once_with("key-t1", 60)
+
+        task.name = "labstro.plugins.simulation.seal"
+        retention.on_postrun(task_id = "t2", task = task)
+        assert backend.expire.call_count == 1
+
+    def test_compact_and_archive(self):
+        self.now = 700.0
+        assert self.retention.compact() == {}
+
+        self.now = 1000.0
+        assert self.retention.compact() == {"elisa-1": 2}
+        assert self.celery.AsyncResult("r-t1").state == "PENDING"
+        summary, source = self.retention.lookup("elisa-1")
+        assert source == "summary"
+        assert summary["states"] == {"SUCCESS": 2}
+        assert [t["result"] for t in summary["tasks"]] == [{"od600": 0}, {"od600": 1}]
+        ## already compacted, the trace is dropped
+        assert self.retention.compact() == {}
+        assert self.traces.protocols() == []
+
+        self.now = 1000.0 + 3600
+        assert self.retention.run() == {"compacted": {}, "archived": ["elisa-1"]}
+        assert os.listdir(self.directory) == ["results-1970-01-01.jsonl.gz"]
+        assert self.retention.summaries.archived("elisa-1") == "results-1970-01-01.jsonl.gz"
+        summary, source = self.retention.lookup("elisa-1")
+        assert source == "archive"
+        assert summary["tasks"][1]["task_id"] == "r-t2"
+        ## archived protocols are not compacted again
+        assert self.retention.run() == {"compacted": {}, "archived": []}
+        assert self.retention.lookup("elisa-1")[1] == "archive"
+
+        ## the API reads an archive the worker did not write to
+        other = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, other)
+        api = ResultRetention(self.celery, self.traces, self.retention.summaries, ResultArchive(other))
+        with self.assertLogs("labstro.retention", "WARNING"):
+            assert api.lookup("elisa-1") == (None, None)
+
+    def test_archive_dir_absolute(self):
+        self.celery.conf.LABSTRO_RETENTION_REDIS_URL = "redis://localhost:6379/3"
+        self.celery.conf.LABSTRO_RETENTION_ARCHIVE_DIR = "archive"
+        with self.assertRaises(ValueError):
+            ResultRetention.from_config(self.celery, self.traces)
+        self.celery.conf.LABSTRO_RETENTION_ARCHIVE_DIR = self.directory
+        assert ResultRetention.from_config(self.celery, self.traces).archive.directory == self.directory
+
+    def test_compact_unfinished(self):
+        """The trace is kept while a task of the protocol has not finished."""
+        self.traces.add("elisa-1", {"event": "queued", "task": "labstro.plugins.simulation.spin",
+                                    "task_id": "r-t3", "instruction": 2, "ts": 300.0})
+        assert self.retention.compact() == {"elisa-1": 2}
+        assert len(self.traces.events("elisa-1")) == 7
+
+        for event, ts in (("started", 1100.0), ("finished", 1200.0)):
+            self.traces.add("elisa-1", {"event": event, "task": "labstro.plugins.simulation.spin",
+                                        "task_id": "r-t3", "instruction": 2, "ts": ts})
+        self.celery.backend.mark_as_done("r-t3", {"od600": 2})
+        assert self.retention.compact("elisa-1") == {"elisa-1": 1}
+        assert self.traces.protocols() == []
+        assert self.retention.lookup("elisa-1")[0]["states"] == {"SUCCESS": 3}
+
+    def test_api(self):
+        app = Flask("test")
+        apiv1.setup_api(Api(app), self.celery, retention = self.retention)
+        client = app.test_client()
+
+        assert client.get("/apiv1/protocol/results/elisa-1").status_code == 404
+        r = client.post("/apiv1/retention", json = {"protocol_id": "elisa-1"})
+        assert r.json["compacted"] == {"elisa-1": 2}
+
+        r = client.get("/apiv1/protocol/results/elisa-1")
+        assert r.status_code == 200
+        assert r.json["source"] == "summary"
+        assert client.get("/apiv1/retention").json["summaries"] == 1
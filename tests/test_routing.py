@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `labstro.routing` module."""
+
+
+import unittest
+
+from celery import Celery
+
+from labstro.manifest import PluginManifest
+from labstro import routing
+
+
+class TestRouting(unittest.TestCase):
+    """Tests for `labstro.routing` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.manifest = PluginManifest()
+        self.manifest.modules = {
+            "labstro.plugins.simulation": {"mtime": None, "instrument": None,
+                                           "operations": {"seal": "labstro.plugins.simulation.seal"}},
+            "acme.washer": {"mtime": None, "instrument": "plate-washer-1",
+                            "operations": {"wash": "acme.washer.wash"}}}
+
+    def test_generate_routes(self):
+        routes = routing.generate_routes(self.manifest,
+                    static = {"acme.*": {"queue": "acme"}})
+
+        assert routes == {"acme.*": {"queue": "acme"},
+                          "acme.washer.*": {"queue": "labstro-plate-washer-1"},
+                          "labstro.plugins.simulation.*": {"queue": "labstro-simulation"}}
+
+    def test_generate_queues(self):
+        routes = routing.generate_routes(self.manifest)
+        queues = routing.generate_queues(routes, max_priority = 10)
+
+        assert [q.name for q in queues] == ["celery", "labstro-plate-washer-1", "labstro-simulation"]
+        assert queues[1].queue_arguments == {"x-max-priority": 10}
+
+    def test_worker_queues(self):
+        self.manifest.routes = routing.generate_routes(self.manifest)
+
+        assert routing.worker_queues(self.manifest, ["acme.washer"]) == ["labstro-plate-washer-1"]
+        with self.assertRaises(ValueError):
+            routing.worker_queues(self.manifest, ["acme.reader"])
+
+    def test_refresh_routes(self):
+        celery = Celery("test", broker = "memory://")
+        now = [0.0]
+        manifest = PluginManifest(plugins = ["labstro.plugins.simulation"])
+        refresher = routing.RouteRefresher(celery, manifest, interval = 60.0,
+                                           clock = lambda: now[0])
+        assert refresher.refresh()
+        assert celery.amqp.router.route({}, "labstro.plugins.simulation.seal")["queue"].name == "labstro-simulation"
+
+        ## a plugin added after startup is routed once the interval passed
+        manifest.plugins.append("labstro.plugins.generic")
+        assert not refresher.maybe_refresh()
+        now[0] = 61.0
+        assert refresher.maybe_refresh()
+        assert "labstro.plugins.generic.*" in celery.conf.task_routes
+        assert "labstro-generic" in celery.amqp.queues
+        assert not refresher.refresh()
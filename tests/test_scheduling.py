@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `labstro.scheduling` module."""
+
+
+from datetime import datetime, timedelta, timezone
+import unittest
+
+from celery import Celery
+from flask import Flask
+from flask_restful import Api
+
+from labstro.api import apiv1
+from labstro.scheduling import DeadlineScheduler, instruction_duration
+
+
+def sealed_protocol(plate, within = "30:second"):
+    """Dispense into a plate then seal it shortly after."""
+    return {"refs": {plate: {"new": "96-pcr", "discard": True}},
+            "instructions": [
+                {"op": "dispense", "object": plate, "reagent": "water",
+                 "columns": [{"column": 0, "volume": "10:microliter"}]},
+                {"op": "seal", "object": plate, "type": "foil", "duration": "5:minute"}],
+            "time_constraints": [{"from": {"instruction_end": 0},
+                                  "to": {"instruction_start": 1},
+                                  "less_than": within}]}
+
+
+class TestDeadlineScheduler(unittest.TestCase):
+    """Tests for `labstro.scheduling` module."""
+
+    def test_instruction_duration(self):
+        assert instruction_duration({"op": "spin", "duration": "1.5:minute"}) == 90.0
+        assert instruction_duration({"op": "incubate", "mode_params": {"duration": "2:hour"}}) == 7200.0
+        assert instruction_duration({"op": "seal"}, default = 10.0) == 10.0
+
+    def test_reorder_for_deadline(self):
+        """The constrained seal of protocol a runs before the long seal of b."""
+        b = {"refs": {"other": {"new": "96-pcr", "discard": True}},
+             "instructions": [{"op": "seal", "object": "other", "duration": "5:minute"}]}
+        schedule = DeadlineScheduler().schedule({"a": sealed_protocol("plate"), "b": b})
+
+        starts = {(e["protocol"], e["instruction"]): e["start"] for e in schedule.entries}
+        assert schedule.feasible
+        assert starts[("a", 1)] == 60.0
+        assert starts[("b", 0)] == 360.0
+
+    def test_delay_predecessor(self):
+        """b's dispense is delayed so its seal follows within 30 seconds."""
+        protocols = {"a": sealed_protocol("plate_a"), "b": sealed_protocol("plate_b")}
+        schedule = DeadlineScheduler().schedule(protocols)
+
+        starts = {(e["protocol"], e["instruction"]): e["start"] for e in schedule.entries}
+        assert schedule.feasible
+        assert starts[("b", 0)] == 270.0
+        assert starts[("b", 1)] == 360.0
+
+        schedule = DeadlineScheduler(capacity = {"seal": 2}).schedule(protocols)
+        assert schedule.feasible
+        assert schedule.makespan == 420.0
+
+    def test_incubate_then_read(self):
+        """The incubation starts late enough for the busy reader to be free."""
+        busy = {"refs": {}, "instructions": [{"op": "read", "duration": "30:minute"}]}
+        protocol = {"refs": {"plate": {"new": "96-flat", "discard": True}},
+                    "instructions": [{"op": "incubate", "object": "plate", "duration": "10:minute"},
+                                     {"op": "read", "object": "plate", "duration": "1:minute"}],
+                    "time_constraints": [{"from": {"instruction_end": 0},
+                                          "to": {"instruction_start": 1},
+                                          "less_than": "1:minute"}]}
+        schedule = DeadlineScheduler().schedule({"busy": busy, "p": protocol})
+
+        starts = {(e["protocol"], e["instruction"]): e["start"] for e in schedule.entries}
+        assert schedule.feasible
+        assert starts[("p", 0)] == 1140.0
+        assert starts[("p", 1)] == 1800.0
+
+    def test_violation(self):
+        """A duration breaking a constraint cannot be fixed by delaying."""
+        protocol = sealed_protocol("plate")
+        protocol["time_constraints"].append({"from": {"instruction_start": 1},
+                                             "to": {"instruction_end": 1},
+                                             "less_than": "1:minute"})
+        schedule = DeadlineScheduler().schedule({"a": protocol})
+        assert not schedule.feasible
+        assert [(v["instruction"], v["late"]) for v in schedule.violations] == [(1, 240.0)]
+
+    def test_more_than(self):
+        protocol = sealed_protocol("plate")
+        protocol["time_constraints"] = [{"from": {"ref_start": "plate"},
+                                         "to": {"ref_end": "plate"},
+                                         "more_than": "10:minute"}]
+        schedule = DeadlineScheduler().schedule({"a": protocol})
+        assert schedule.entries[1]["start"] == 300.0
+
+    def test_same_instruction(self):
+        """A constraint between the start and end of one instruction bounds its duration."""
+        protocol = sealed_protocol("plate")
+        protocol["time_constraints"] = [{"from": {"instruction_start": 1},
+                                         "to": {"instruction_end": 1},
+                                         "less_than": "1:minute"}]
+        schedule = DeadlineScheduler().schedule({"a": protocol})
+        assert [(v["instruction"], v["late"]) for v in schedule.violations] == [(1, 240.0)]
+
+    def test_ref_names(self):
+        """Refs are matched by whole name, "plate" does not match "plate_2"."""
+        protocol = sealed_protocol("plate")
+        protocol["refs"]["plate_2"] = {"new": "96-pcr", "discard": True}
+        protocol["instructions"].append({"op": "seal", "object": "plate_2", "type": "foil"})
+        protocol["time_constraints"] = [{"from": {"ref_start": "plate"},
+                                         "to": {"ref_end": "plate"},
+                                         "less_than": "1:minute"}]
+        schedule = DeadlineScheduler().schedule({"a": protocol})
+        assert [v["instruction"] for v in schedule.violations] == [1]
+
+    def test_reserve(self):
+        """Dispatched schedules hold their instruments until their planned end."""
+        scheduler = DeadlineScheduler()
+        now = datetime(2020, 1, 1, tzinfo = timezone.utc)
+        first = scheduler.schedule({"a": sealed_protocol("plate")}, now = now)
+        scheduler.reserve(first)
+
+        second = scheduler.schedule({"b": sealed_protocol("plate")}, now = now + timedelta(seconds = 30))
+        assert [e["start"] for e in second.entries] == [240.0, 330.0]
+
+        third = scheduler.schedule({"c": sealed_protocol("plate")}, now = now + timedelta(seconds = 360))
+        assert [e["start"] for e in third.entries] == [0.0, 60.0]
+
+    def test_to_celery(self):
+        schedule = DeadlineScheduler().schedule({"a": sealed_protocol("plate")})
+        now = datetime(2020, 1, 1, tzinfo = timezone.utc)
+        workflow = schedule.to_celery(["labstro.plugins.simulation"], now = now)
+
+        assert [t.options["eta"] for t in workflow.tasks] == [now, now + timedelta(seconds = 60)]
+
+    def test_api(self):
+        app = Flask("test")
+        scheduler = DeadlineScheduler()
+        apiv1.setup_api(Api(app), Celery("test", broker = "memory://"), scheduler = scheduler)
+        client = app.test_client()
+        protocols = {"a": sealed_protocol("plate_a"), "b": sealed_protocol("plate_b")}
+
+        r = client.post("/apiv1/schedule", json = {"protocols": protocols})
+        assert r.status_code == 200
+        assert len(r.json["entries"]) == 4
+        assert r.json["feasible"]
+
+        r = client.post("/apiv1/schedule", json = {"protocols": {}, "dispatch": True})
+        assert r.status_code == 400
+
+        infeasible = sealed_protocol("plate")
+        infeasible["time_constraints"].append({"from": {"instruction_start": 1},
+                                               "to": {"instruction_end": 1},
+                                               "less_than": "1:minute"})
+        r = client.post("/apiv1/schedule",
+                        json = {"protocols": {"c": infeasible}, "strict": True, "dispatch": True})
+        assert r.status_code == 409
+        assert "task-id" not in r.json
+        assert scheduler.calendar.lanes("seal") == [[]]
+
+        r = client.post("/apiv1/schedule",
+                        json = {"protocols": protocols, "plugins": ["labstro.plugins.simulation"],
+                                "dispatch": True})
+        assert r.status_code == 200
+        assert "task-id" in r.json
+        assert len(scheduler.calendar.lanes("seal")[0]) == 2
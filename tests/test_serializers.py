@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `labstro.serializers` module."""
+
+
+from decimal import Decimal
+import unittest
+
+from celery import Celery
+from flask import Flask
+from flask_restful import Api, Resource
+from kombu.serialization import dumps, loads
+
+from labstro import serializers
+
+
+class Echo(Resource):
+    def get(self):
+        return {"volume": Decimal("1.5"), "wells": ("A1", "A2")}, 200
+
+
+class TestSerializers(unittest.TestCase):
+    """Tests for `labstro.serializers` module."""
+
+    def test_round_trip(self):
+        message = [{"test pcr plate": {"new": "96-pcr"}}, {"op": "spin", "index": (1, 2)}]
+        content_type, encoding, data = dumps(message, serializer = "orjson")
+
+        assert loads(data, content_type, encoding) == \
+            [{"test pcr plate": {"new": "96-pcr"}}, {"op": "spin", "index": [1, 2]}]
+
+    def test_setup_celery(self):
+        celery = Celery("test", broker = "memory://")
+
+        assert serializers.setup_celery(celery, "orjson") == "orjson"
+        assert celery.conf.accept_content == ["json", "orjson"]
+        with self.assertRaises(ValueError):
+            serializers.setup_celery(celery, "unknown")
+        assert celery.conf.task_serializer == "orjson"
+
+    def test_setup_flask(self):
+        app = Flask("test")
+        api = Api(app)
+        serializers.setup_flask(api, "orjson")
+        api.add_resource(Echo, "/echo")
+
+        r = app.test_client().get("/echo")
+        assert r.json == {"volume": "1.5", "wells": ["A1", "A2"]}
+
+    def test_benchmark(self):
+        result = serializers.benchmark(number = 1)
+
+        assert set(["json", "orjson"]) <= set(result)
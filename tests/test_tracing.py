@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `labstro.tracing` module."""
+
+
+import os
+import json
+import unittest
+
+from celery import Celery
+
+from labstro.labstro import AutoprotocolToCelery
+from labstro.local import LocalEngine
+from labstro.tracing import LocalTraceStore, Tracer, chrome_trace
+
+
+class TestTracing(unittest.TestCase):
+    """Tests for `labstro.tracing` module."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        with open(os.path.join(os.path.dirname(__file__), "protocol.json"), "r") as f:
+            self.protocol_dict = json.load(f)
+        self.plugins = ["labstro.plugins.simulation"]
+        self.store = LocalTraceStore()
+        self.tracer = Tracer(self.store).connect()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self.tracer.disconnect()
+
+    def test_publish(self):
+        celery = Celery("test", broker = "memory://")
+        sig = celery.signature("labstro.plugins.simulation.seal",
+                               headers = {"labstro_protocol_id": "p1", "labstro_instruction": 0})
+        sig.apply_async()
+
+        events = self.store.events("p1")
+        assert [e["event"] for e in events] == ["queued"]
+        assert events[0]["instruction"] == 0
+
+    def test_local_execution(self):
+        sig = AutoprotocolToCelery().to_celery(self.protocol_dict, self.plugins,
+                                               protocol_id = "p2")
+        with LocalEngine() as engine:
+            engine.apply(sig)
+
+        events = self.store.events("p2")
+        assert [(e["event"], e["instruction"]) for e in events] == \
+            [("started", 0), ("finished", 0), ("started", 1), ("finished", 1)]
+
+        trace = chrome_trace("p2", events)
+        tasks = [e for e in trace["traceEvents"] if e["ph"] == "X"]
+        assert [e["name"] for e in tasks] == ["seal", "spin"]
+        assert all(e["dur"] >= 0 for e in tasks)